@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Compare encode/decode time and payload size of the available wire codecs.
+# Install orjson, msgpack and cbor2 to include the optional codecs.
+#
+# Usage: bench_codecs.py [--rows N] [--repeat N] [--json]
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+import swa_codecs
+
+def payloads(rows):
+    users = [{"id":i, "username":"user" + str(i) + "@example.com", "role":"user"}
+             for i in range(rows)]
+    return {
+        "small":{"success":True, "result":{"capabilities":["user", "view"], "user":"user@example.com"}},
+        "users":{"success":True, "result":users},
+        "numbers":{"success":True, "result":list(range(rows * 10))},
+        "floats":{"success":True, "result":[i / 7 for i in range(rows * 10)]},
+    }
+
+def bench(codec, value, repeat):
+    data = codec.dumps(value)
+    number = max(1, 10000 // max(1, len(data) // 100))
+    encode = min(timeit.repeat(lambda: codec.dumps(value), number=number, repeat=repeat)) / number
+    decode = min(timeit.repeat(lambda: codec.loads(data), number=number, repeat=repeat)) / number
+    return {"codec":codec.name,
+            "content_type":codec.content_type,
+            "bytes":len(data),
+            "encode_us":encode * 1e6,
+            "decode_us":decode * 1e6}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark wire codecs.")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows in the large payloads.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    args = parser.parse_args()
+
+    codecs = []
+    for codec in swa_codecs.codecs.values():
+        if codec not in codecs:
+            codecs.append(codec)
+    if swa_codecs.orjson:
+        codecs.append(swa_codecs.Codec("json (stdlib)", "application/json",
+                                       swa_codecs.json_dumps, swa_codecs.json_loads))
+
+    results = []
+    for name, value in payloads(args.rows).items():
+        for codec in codecs:
+            result = bench(codec, value, args.repeat)
+            result["payload"] = name
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<10} {:<15} {:>10} {:>12} {:>12}".format("payload", "codec", "bytes", "encode us", "decode us"))
+    for r in results:
+        print("{payload:<10} {codec:<15} {bytes:>10} {encode_us:>12.1f} {decode_us:>12.1f}".format(**r))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Measure the Python overhead of dispatching a call to a trivial method,
+# comparing SimpleWebAPI.call with the per-request dict plumbing it replaced.
+# Session lookups are stubbed out so only dispatch cost is measured.
+#
+# Usage: bench_dispatch.py [--number N] [--repeat N] [--json]
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from swa import SimpleWebAPI, SimpleWebAPIError
+
+class FakeRequest:
+    remote_addr = "127.0.0.1"
+    cookies = {"token":"token"}
+
+def legacy_call(api_methods, inp, request, check_token, get_capabilities):
+    """The dispatch code used before methods were compiled into invokers."""
+    method = inp['method']
+    conf = api_methods[method]
+    kwargs = inp.get("kwargs", {})
+    token = None
+    if "token" in inp:
+        token = inp["token"]
+    elif "token" in request.cookies:
+        token = request.cookies["token"]
+    user = check_token(token)
+    capabilities = get_capabilities(user)
+    if not capabilities:
+        capabilities = set()
+    details = {
+            "ip":request.remote_addr,
+            "user":user,
+            "capabilities":capabilities,
+            "token":token,
+            "request":request
+            }
+    if conf["details"]:
+        kwargs["details"] = details
+    require = conf["require"]
+    if require == None or require in capabilities:
+        try:
+            res = {"success":True,
+                   "result":conf["method"](*inp.get("args", []), **kwargs)}
+        except SimpleWebAPIError as ex:
+            res = {"success":False,
+                   "error":ex.error_name,
+                   "error_message":ex.message}
+    return res, details["token"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-call dispatch overhead.")
+    parser.add_argument("--number", type=int, default=100000, help="Calls per timing run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    args = parser.parse_args()
+
+    def check_token(token):
+        return "user@example.com"
+
+    def get_capabilities(user):
+        return {"user"}
+
+    def echo(text):
+        return text
+
+    api = SimpleWebAPI()
+    api.set_token_lookup_handler(check_token)
+    api.set_capability_handler(get_capabilities)
+    api.add(require=None, name="public_echo")(echo)
+    api.add(require="user", name="user_echo")(echo)
+
+    legacy_methods = defaultdict(dict)
+    legacy_methods["public_echo"] = {"method":echo, "require":None, "details":False}
+    legacy_methods["user_echo"] = {"method":echo, "require":"user", "details":False}
+
+    request = FakeRequest()
+    results = []
+    for name in ("public_echo", "user_echo"):
+        cases = {
+            "legacy":lambda: legacy_call(legacy_methods, {"method":name, "args":["hi"]},
+                                         request, check_token, get_capabilities),
+            "invoker":lambda: api.call({"method":name, "args":["hi"]}, request),
+        }
+        for case, function in cases.items():
+            best = min(timeit.repeat(function, number=args.number, repeat=args.repeat))
+            results.append({"method":name, "dispatch":case, "ns_per_call":best / args.number * 1e9})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<12} {:<8} {:>12}".format("method", "dispatch", "ns/call"))
+    for r in results:
+        print("{method:<12} {dispatch:<8} {ns_per_call:>12.0f}".format(**r))
+
+if __name__ == "__main__":
+    main()
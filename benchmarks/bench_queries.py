@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Measure the CPU time of the session manager's per-request queries,
+# comparing the prepared statements with building each statement per call
+# as was done before. Runs against SQLite with the session cache off, so
+# every lookup reaches the database.
+#
+# Usage: bench_queries.py [--number N] [--repeat N] [--users N] [--json]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from sqlalchemy import create_engine, select, and_
+from swa import SimpleWebAPI
+from email_session_manager import EmailSessionManager
+
+def legacy_resolve(session, token_crypt):
+    """The identity lookup as it was written before statements were prepared."""
+    users = session.metadata.tables['users']
+    tokens = session.metadata.tables['tokens']
+    s = (select(users.c.id, users.c.username, users.c.role, tokens.c.expire)
+        .select_from(tokens.join(users))
+        .where(and_(tokens.c.token == token_crypt,
+               tokens.c.expire > time.time())))
+    with session.database.begin() as conn:
+        return conn.execute(s).fetchone()
+
+def prepared_resolve(session, token_crypt):
+    with session.database.begin() as conn:
+        return conn.execute(session.identity_select, {"token_crypt":token_crypt, "now":time.time()}).fetchone()
+
+def legacy_get_user(session, username):
+    users = session.metadata.tables['users']
+    with session.database.begin() as conn:
+        return conn.execute(select(users.c).where(users.c.username == username)).fetchone()
+
+def cpu_per_call(function, number, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        for j in range(number):
+            function()
+        elapsed = time.process_time() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best / number
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU cost of session queries.")
+    parser.add_argument("--number", type=int, default=5000, help="Calls per timing run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions.")
+    parser.add_argument("--users", type=int, default=1000, help="Users, each with one session.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = create_engine("sqlite:///" + os.path.join(directory, "queries.db"))
+        session = EmailSessionManager(SimpleWebAPI(), database)
+        session.upd_settings({"roles":{"root":None, "user":None}, "default_role":"user",
+                              "admin_user":"admin@example.com", "reap_interval":0,
+                              "session_cache_size":0})
+        tokens = [session.gen_token("user" + str(i) + "@example.com") for i in range(args.users)]
+        token = tokens[len(tokens) // 2]
+        token_crypt = session.token_hmac(token)
+        username = "user" + str(args.users // 2) + "@example.com"
+
+        cases = [
+            ("resolve_token", "legacy", lambda: legacy_resolve(session, token_crypt)),
+            ("resolve_token", "prepared", lambda: prepared_resolve(session, token_crypt)),
+            ("get_user", "legacy", lambda: legacy_get_user(session, username)),
+            ("get_user", "prepared", lambda: session.get_user(username)),
+            ("check_token", "prepared", lambda: session.check_token(token)),
+        ]
+        results = []
+        for query, statement, function in cases:
+            function()
+            results.append({"query":query, "statement":statement,
+                            "us_per_call":cpu_per_call(function, args.number, args.repeat) * 1e6})
+        database.dispose()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:<14} {:<9} {:>10}".format("query", "statement", "cpu us"))
+    for r in results:
+        print("{query:<14} {statement:<9} {us_per_call:>10.1f}".format(**r))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Load test SimpleWebAPI and EmailSessionManager in-process against SQLite,
+# with email captured instead of sent. Each scenario runs for a fixed time at
+# each concurrency level and session table size, reporting requests/sec and
+# latency percentiles. Save the --json output of a release and pass it to
+# --compare to catch regressions.
+#
+# Scenarios:
+#   anonymous      getMethods without a session.
+#   authenticated  getDetails with a session, through the session cache.
+#   uncached       getDetails with the session cache turned off.
+#   signed         getDetails with signed tokens, checked without the database.
+#   otp            send_otp followed by login, timed together.
+#   large_result   get_all_users as an account manager.
+#   bundle         GET of the generated .js client.
+#
+# Usage: bench_server.py [--scenarios LIST] [--concurrency LIST] [--tokens LIST]
+#                        [--duration S] [--json] [--compare FILE]
+import argparse
+import json
+import os
+import platform
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+import sqlalchemy
+from sqlalchemy import create_engine
+from werkzeug.test import Client
+from swa import SimpleWebAPI
+from email_session_manager import EmailSessionManager
+
+scenarios = ("anonymous", "authenticated", "uncached", "signed", "otp", "large_result", "bundle")
+
+class CaptureTransport:
+    """Keep login codes for the benchmark instead of sending email."""
+    def __init__(self):
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    def inbox(self, recipient):
+        with self.lock:
+            if recipient not in self.codes:
+                self.codes[recipient] = queue.Queue()
+            return self.codes[recipient]
+
+    def send(self, recipient, subject, text):
+        self.inbox(recipient).put(re.search(r"code (\w+)", text).group(1))
+
+class Server:
+    """A session manager and API on a fresh SQLite database with tokens sessions."""
+    def __init__(self, directory, tokens, users, active, otp_iterations):
+        self.database = create_engine("sqlite:///" + os.path.join(directory, "bench-" + str(tokens) + ".db"))
+        self.api = SimpleWebAPI()
+        self.api.upd_settings({"default_capability":"user"})
+        self.session = EmailSessionManager(self.api, self.database)
+        self.session.upd_settings({
+            "roles":{"root":["admin"], "admin":["user", "accountmanager"], "user":None, "nobody":None},
+            "default_role":"user",
+            "admin_email":"admin@example.com",
+            "admin_user":"admin@example.com",
+            "otp_iterations":otp_iterations,
+            "reap_interval":0,
+            "token_secret":"bench-" + "%032x" % random.getrandbits(128),
+            "revocation_refresh":0,
+        })
+        self.mail = CaptureTransport()
+        self.session.set_mail_transport(self.mail)
+        self.seed(tokens, users, active)
+        self.admin_token = self.session.gen_token("admin@example.com")
+        self.session.token_format = "signed"
+        self.signed_tokens = [self.session.gen_token("user" + str(i) + "@example.com")
+                              for i in range(min(users, 100))]
+        self.session.token_format = "opaque"
+
+    def seed(self, tokens, users, active):
+        """Add users and tokens, keeping the plaintext of the first active tokens."""
+        rng = random.Random(tokens)
+        user_table = self.session.metadata.tables['users']
+        token_table = self.session.metadata.tables['tokens']
+        with self.database.begin() as conn:
+            conn.execute(user_table.insert(), [{"username":"user" + str(i) + "@example.com", "role":"user"}
+                                               for i in range(users)])
+            user_ids = [row[0] for row in conn.execute(sqlalchemy.select(user_table.c.id))]
+        expire = int(time.time() + self.session.token_ttl)
+        self.tokens = []
+        for start in range(0, tokens, 10000):
+            rows = []
+            for i in range(start, min(tokens, start + 10000)):
+                token = "%064x" % rng.getrandbits(256)
+                if i < active:
+                    self.tokens.append(token)
+                    token = self.session.token_hmac(token)
+                rows.append({"user_id":rng.choice(user_ids), "token":token, "expire":expire})
+            with self.database.begin() as conn:
+                conn.execute(token_table.insert(), rows)
+
+def call(client, method, args=(), token=None):
+    body = {"method":method, "args":list(args), "version":2}
+    if token != None:
+        body["token"] = token
+    response = client.post("/", data=json.dumps(body), content_type="application/json")
+    return json.loads(response.data)
+
+def request(server, scenario, client, rng, worker):
+    """Make one request, or one login flow. Returns its latency and whether it succeeded."""
+    start = time.perf_counter()
+    if scenario == "anonymous":
+        ok = call(client, "getMethods")["success"]
+    elif scenario in ("authenticated", "uncached"):
+        ok = call(client, "getDetails", token=rng.choice(server.tokens))["result"]["user"] != None
+    elif scenario == "signed":
+        ok = call(client, "getDetails", token=rng.choice(server.signed_tokens))["result"]["user"] != None
+    elif scenario == "large_result":
+        ok = call(client, "get_all_users", token=server.admin_token)["success"]
+    elif scenario == "bundle":
+        response = client.get("/.js", headers={"Accept-Encoding":"gzip, br"})
+        ok = response.status_code == 200
+        response.close()
+    elif scenario == "otp":
+        user = "flow" + str(worker) + "@example.com"
+        res = call(client, "send_otp", [user])
+        elapsed = time.perf_counter() - start
+        if not res["success"]:
+            return elapsed, False
+        code = server.mail.inbox(user).get(timeout=30)
+        start = time.perf_counter()
+        ok = call(client, "login", [user, code], token=res["result"])["result"]["success"]
+        return elapsed + time.perf_counter() - start, ok
+    return time.perf_counter() - start, ok
+
+def run(server, scenario, concurrency, duration):
+    server.session.session_cache.size = 0 if scenario == "uncached" else server.session.session_cache_size
+    server.session.session_cache.clear()
+    latencies = [[] for i in range(concurrency)]
+    errors = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        client = Client(server.api.application)
+        rng = random.Random(index)
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            try:
+                latency, ok = request(server, scenario, client, rng, index)
+            except Exception:
+                errors[index] += 1
+                continue
+            latencies[index].append(latency)
+            if not ok:
+                errors[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    times = sorted(latency for worker_times in latencies for latency in worker_times)
+
+    def percentile(p):
+        if not times:
+            return None
+        return times[min(len(times) - 1, int(len(times) * p / 100))] * 1000
+
+    return {"requests":len(times),
+            "errors":sum(errors),
+            "rps":len(times) / elapsed,
+            "p50_ms":percentile(50),
+            "p90_ms":percentile(90),
+            "p99_ms":percentile(99),
+            "max_ms":times[-1] * 1000 if times else None}
+
+def compare(results, baseline_file, threshold):
+    """Print results whose throughput fell by more than threshold. Returns their number."""
+    with open(baseline_file) as f:
+        baseline = {(r["scenario"], r["concurrency"], r["tokens"]):r for r in json.load(f)["results"]}
+    regressions = 0
+    for r in results:
+        old = baseline.get((r["scenario"], r["concurrency"], r["tokens"]))
+        if old and old["rps"] and r["rps"] < old["rps"] * (1 - threshold):
+            regressions += 1
+            print("Regression: {scenario} at concurrency {concurrency} with {tokens} tokens:"
+                  " {old:.1f} -> {rps:.1f} req/s".format(old=old["rps"], **r), file=sys.stderr)
+    return regressions
+
+def int_list(text):
+    return [int(float(value)) for value in text.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API server in-process.")
+    parser.add_argument("--scenarios", default=",".join(scenarios), help="Comma separated scenarios to run.")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16], help="Comma separated thread counts.")
+    parser.add_argument("--tokens", type=int_list, default=[1000, 100000],
+                        help="Comma separated session table sizes, such as 1e3,1e6.")
+    parser.add_argument("--users", type=int, default=1000, help="Users in the users table.")
+    parser.add_argument("--active", type=int, default=1000, help="Sessions used by authenticated calls.")
+    parser.add_argument("--duration", type=float, default=2.0, help="Seconds to run each case.")
+    parser.add_argument("--otp-iterations", type=int, default=100000, help="PBKDF2 iterations for login codes.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Drop in requests/sec, as a fraction, counted as a regression.")
+    args = parser.parse_args()
+
+    selected = args.scenarios.split(",")
+    for scenario in selected:
+        if scenario not in scenarios:
+            parser.error("unknown scenario '" + scenario + "'")
+
+    if not args.json:
+        print("{:<14} {:>4} {:>9} {:>8} {:>6} {:>9} {:>8} {:>8} {:>8}".format(
+              "scenario", "conc", "tokens", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms"))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for tokens in args.tokens:
+            server = Server(directory, tokens, args.users, min(args.active, tokens), args.otp_iterations)
+            for scenario in selected:
+                for concurrency in args.concurrency:
+                    result = {"scenario":scenario, "concurrency":concurrency, "tokens":tokens}
+                    result.update(run(server, scenario, concurrency, args.duration))
+                    results.append(result)
+                    if not args.json:
+                        print("{scenario:<14} {concurrency:>4} {tokens:>9} {requests:>8} {errors:>6} {rps:>9.1f}"
+                              " {p50_ms:>8.2f} {p90_ms:>8.2f} {p99_ms:>8.2f}".format(**result))
+            server.database.dispose()
+
+    if args.json:
+        print(json.dumps({"python":platform.python_version(),
+                          "platform":platform.platform(),
+                          "sqlalchemy":sqlalchemy.__version__,
+                          "settings":{"users":args.users, "active":args.active,
+                                      "duration":args.duration, "otp_iterations":args.otp_iterations},
+                          "results":results}, indent=2))
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Time how long the spa.wsgi boot path takes in a fresh interpreter, as a
+# mod_wsgi process does when it starts or is recycled. Each run boots
+# spa.wsgi against a SQLite database holding the session tables and
+# --extra-tables unrelated tables, standing in for a shared schema.
+# Reports the time to import the server modules and the total boot time.
+#
+# Usage: bench_startup.py [--runs N] [--extra-tables N] [--json] [--max-ms MS]
+#
+# With --max-ms, exits with status 1 if the median boot time exceeds it.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+server_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+# Run in the child interpreter. Prints the import and boot times in milliseconds.
+boot_script = """
+import runpy, sys, time
+start = time.perf_counter()
+import swa, email_session_manager
+imported = time.perf_counter()
+runpy.run_path(sys.argv[1])
+booted = time.perf_counter()
+print((imported - start) * 1000, (booted - start) * 1000, "requests" in sys.modules)
+"""
+
+def setup(directory, extra_tables):
+    """Write a configuration and app for spa.wsgi, and create the database."""
+    database = "sqlite:///" + os.path.join(directory, "startup.db")
+    conf = {"api":{"default_capability":"user"},
+            "database":database,
+            "session":{"roles":{"root":["admin"], "admin":["user"], "user":None},
+                       "default_role":"user",
+                       "admin_email":"admin@example.com",
+                       "admin_user":"admin@example.com",
+                       "reap_interval":0}}
+    with open(os.path.join(directory, "swa-conf.json"), "w") as f:
+        json.dump(conf, f)
+    with open(os.path.join(directory, "app.py"), "w") as f:
+        f.write("def init(api):\n    pass\n")
+    sys.path.insert(0, server_dir)
+    from sqlalchemy import create_engine, text
+    engine = create_engine(database)
+    with engine.begin() as conn:
+        for i in range(extra_tables):
+            conn.execute(text("CREATE TABLE other_%d (id INTEGER PRIMARY KEY, name VARCHAR(100), "
+                              "created INTEGER, owner INTEGER)" % i))
+            conn.execute(text("CREATE INDEX ix_other_%d_name ON other_%d (name)" % (i, i)))
+    engine.dispose()
+    # Boot once so the session tables exist, as they would in production.
+    boot(directory)
+
+def boot(directory):
+    env = dict(os.environ, SWA_CONF=os.path.join(directory, "swa-conf.json"),
+               PYTHONPATH=os.pathsep.join([directory, server_dir, os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.run([sys.executable, "-c", boot_script, os.path.join(server_dir, "spa.wsgi")],
+                            env=env, cwd=directory, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    imported, booted, requests_loaded = output.split()[-3:]
+    return float(imported), float(booted), requests_loaded == "True"
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the spa.wsgi boot path.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of boots to time.")
+    parser.add_argument("--extra-tables", type=int, default=300, help="Unrelated tables in the database.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median boot takes longer than this.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory, args.extra_tables)
+        runs = [boot(directory) for i in range(args.runs)]
+
+    result = {"runs":args.runs,
+              "extra_tables":args.extra_tables,
+              "import_ms":statistics.median(run[0] for run in runs),
+              "boot_ms":statistics.median(run[1] for run in runs),
+              "boot_max_ms":max(run[1] for run in runs),
+              "requests_imported":any(run[2] for run in runs)}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("import {import_ms:.1f} ms, boot {boot_ms:.1f} ms median, {boot_max_ms:.1f} ms max"
+              " over {runs} runs with {extra_tables} extra tables".format(**result))
+        if result["requests_imported"]:
+            print("requests was imported during boot.")
+    if args.max_ms != None and result["boot_ms"] > args.max_ms:
+        print("Boot took {boot_ms:.1f} ms, over the limit of {max_ms:.1f} ms.".format(
+              max_ms=args.max_ms, **result), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# Add the indexes used by session lookups. On MySQL the indexes are built
+# online, so the tables stay readable and writable while this runs.
+from sqlalchemy import inspect, text
+
+indexes = [
+    ("users", "ix_users_username", "username", True),
+    ("tokens", "ix_tokens_token", "token", True),
+    ("tokens", "ix_tokens_user_id", "user_id", False),
+    ("challenges", "ix_challenges_token", "token", False),
+    ("challenges", "ix_challenges_expire", "expire", False),
+]
+
+def check_duplicates(database, table, column):
+    s = text("SELECT " + column + ", COUNT(*) FROM " + table +
+             " GROUP BY " + column + " HAVING COUNT(*) > 1")
+    with database.connect() as conn:
+        duplicates = conn.execute(s).fetchall()
+    if duplicates:
+        raise Exception("Cannot add unique index on " + table + "." + column +
+                        ", remove these duplicates first: " +
+                        ", ".join(str(row[0]) for row in duplicates))
+
+def upgrade(database, conf):
+    inspector = inspect(database)
+    for table, name, column, unique in indexes:
+        if name in [index["name"] for index in inspector.get_indexes(table)]:
+            continue
+        if unique:
+            check_duplicates(database, table, column)
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        if database.dialect.name == "mysql":
+            statement = ("ALTER TABLE " + table + " ADD " + kind + " " + name +
+                         " (" + column + "), ALGORITHM=INPLACE, LOCK=NONE")
+        else:
+            statement = "CREATE " + kind + " " + name + " ON " + table + " (" + column + ")"
+        print("  " + statement)
+        with database.begin() as conn:
+            conn.execute(text(statement))
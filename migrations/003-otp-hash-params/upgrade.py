@@ -0,0 +1,13 @@
+# Widen challenges.otp so hashes can record their parameters.
+from sqlalchemy import text
+
+def upgrade(database, conf):
+    if database.dialect.name == "mysql":
+        statement = "ALTER TABLE challenges MODIFY otp VARCHAR(128) NOT NULL"
+    elif database.dialect.name == "postgresql":
+        statement = "ALTER TABLE challenges ALTER COLUMN otp TYPE VARCHAR(128)"
+    else:
+        return
+    print("  " + statement)
+    with database.begin() as conn:
+        conn.execute(text(statement))
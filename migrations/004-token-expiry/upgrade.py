@@ -0,0 +1,21 @@
+# Give tokens an expiry time. Existing tokens expire one token_ttl from now.
+import time
+from sqlalchemy import inspect, text
+
+def upgrade(database, conf):
+    ttl = conf.get("session", {}).get("token_ttl", 31557600)
+    if "expire" not in [column["name"] for column in inspect(database).get_columns("tokens")]:
+        with database.begin() as conn:
+            conn.execute(text("ALTER TABLE tokens ADD COLUMN expire INTEGER"))
+    with database.begin() as conn:
+        conn.execute(text("UPDATE tokens SET expire = :expire WHERE expire IS NULL"),
+                     {"expire": int(time.time() + ttl)})
+    if "ix_tokens_expire" in [index["name"] for index in inspect(database).get_indexes("tokens")]:
+        return
+    if database.dialect.name == "mysql":
+        statement = "ALTER TABLE tokens ADD INDEX ix_tokens_expire (expire), ALGORITHM=INPLACE, LOCK=NONE"
+    else:
+        statement = "CREATE INDEX ix_tokens_expire ON tokens (expire)"
+    print("  " + statement)
+    with database.begin() as conn:
+        conn.execute(text(statement))
@@ -0,0 +1,21 @@
+# Add the per-user token generation and the revocations table used by signed tokens.
+from sqlalchemy import inspect, text, Table, Column, Index, Integer, String, MetaData, ForeignKey
+
+def upgrade(database, conf):
+    if "token_generation" not in [column["name"] for column in inspect(database).get_columns("users")]:
+        statement = "ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0"
+        print("  " + statement)
+        with database.begin() as conn:
+            conn.execute(text(statement))
+    metadata = MetaData()
+    Table("users", metadata, Column('id', Integer, primary_key=True))
+    Table("revocations", metadata,
+          Column('id', Integer, primary_key=True),
+          Column('user_id', None, ForeignKey('users.id'), nullable=False),
+          Column('token_id', String(16)),
+          Column('generation', Integer),
+          Column('role', String(25)),
+          Column('expire', Integer, nullable=False),
+          Index('ix_revocations_expire', 'expire'),
+    )
+    metadata.tables["revocations"].create(database, checkfirst=True)
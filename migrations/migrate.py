@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Apply pending migrations to the database named in /etc/swa-conf.json.
+#
+# Each migration is a folder named NNN-description next to this script. It may
+# contain any of the following, which are applied in this order:
+#   schema-update.sql  SQL statements separated by semicolons.
+#   upgrade.py         A module defining upgrade(database, conf).
+#   data-upgrade.py    A standalone script (used by older migrations).
+#
+# The applied version is stored in the swa_schema_version table. Databases
+# created by EmailSessionManager.gen_db_schema start out at the current version.
+# Databases from before migrations were tracked are assumed to be at version 1
+# unless --baseline is given. Databases whose version was kept in a table named
+# schema_version by earlier releases carry it over; the old table is left alone.
+import argparse
+import json
+import os
+import runpy
+import sys
+from sqlalchemy import create_engine, inspect, text, Table, Column, Integer, MetaData, select
+
+migrations_dir = os.path.dirname(os.path.abspath(__file__))
+
+def list_migrations():
+    migrations = []
+    for name in sorted(os.listdir(migrations_dir)):
+        path = os.path.join(migrations_dir, name)
+        version = name.split("-", 1)[0]
+        if os.path.isdir(path) and version.isdigit():
+            migrations.append((int(version), name, path))
+    return migrations
+
+def legacy_version(database):
+    """Return the version in the schema_version table used by earlier releases,
+       or None if there is no such table or it belongs to another tool."""
+    if not inspect(database).has_table("schema_version"):
+        return None
+    if [column["name"] for column in inspect(database).get_columns("schema_version")] != ["version"]:
+        return None
+    with database.begin() as conn:
+        row = conn.execute(text("SELECT version FROM schema_version")).fetchone()
+    return row[0] if row else None
+
+def get_version(database, schema_version, baseline):
+    with database.begin() as conn:
+        row = conn.execute(select(schema_version.c.version)).fetchone()
+        if row:
+            return row[0]
+        conn.execute(schema_version.insert().values(version=baseline))
+    return baseline
+
+def set_version(database, schema_version, version):
+    with database.begin() as conn:
+        conn.execute(schema_version.update().values(version=version))
+
+def apply_migration(database, conf, path):
+    sql_file = os.path.join(path, "schema-update.sql")
+    if os.path.exists(sql_file):
+        with open(sql_file) as f:
+            statements = [x.strip() for x in f.read().split(";")]
+        with database.begin() as conn:
+            for statement in statements:
+                if statement:
+                    conn.execute(text(statement))
+    upgrade_file = os.path.join(path, "upgrade.py")
+    if os.path.exists(upgrade_file):
+        runpy.run_path(upgrade_file)["upgrade"](database, conf)
+    data_file = os.path.join(path, "data-upgrade.py")
+    if os.path.exists(data_file):
+        runpy.run_path(data_file, run_name="__main__")
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending database migrations.")
+    parser.add_argument("--conf", default="/etc/swa-conf.json", help="Configuration file.")
+    parser.add_argument("--baseline", type=int, default=1,
+                        help="Version of an existing database that has no swa_schema_version table.")
+    parser.add_argument("--dry-run", action="store_true", help="Only list pending migrations.")
+    args = parser.parse_args()
+
+    conf = json.load(open(args.conf))
+    database = create_engine(conf["database"], pool_recycle=3600)
+    if not inspect(database).has_table("tokens"):
+        print("No session tables found. They are created at the current version on first start.")
+        return
+
+    metadata = MetaData()
+    schema_version = Table("swa_schema_version", metadata,
+          Column('version', Integer, nullable=False),
+    )
+    if not inspect(database).has_table("swa_schema_version"):
+        baseline = legacy_version(database)
+        if baseline != None:
+            args.baseline = baseline
+    if args.dry_run and not inspect(database).has_table("swa_schema_version"):
+        version = args.baseline
+    else:
+        metadata.create_all(database)
+        version = get_version(database, schema_version, args.baseline)
+
+    pending = [m for m in list_migrations() if m[0] > version]
+    if not pending:
+        print("Database is up to date at version " + str(version) + ".")
+        return
+    for number, name, path in pending:
+        print("Applying " + name + "...")
+        if not args.dry_run:
+            apply_migration(database, conf, path)
+            set_version(database, schema_version, number)
+    if not args.dry_run:
+        print("Database is now at version " + str(pending[-1][0]) + ".")
+
+if __name__ == "__main__":
+    sys.exit(main())
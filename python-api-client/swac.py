@@ -1,5 +1,14 @@
+import asyncio
+import hashlib
+import http.client
+import inspect
+import io
 import json
-import urllib.request
+import os
+import ssl
+import threading
+import urllib.error
+import urllib.parse
 
 class SimpleWebAPIError(Exception):
     def __init__(self, error_name="SimpleWebAPIError", message="An unknown error occured."):
@@ -8,34 +17,539 @@ class SimpleWebAPIError(Exception):
     def __str__(self):
         return str(self.error_name) + ": " + str(self.message)
 
+# Version of the schema format this client understands.
+schema_version = 1
+
+def schema_hash(methods):
+    return hashlib.sha256(json.dumps(methods, sort_keys=True).encode('UTF-8')).hexdigest()[:32]
+
+class DefaultRepr:
+    """Stands for a default value that could not be sent as JSON."""
+    def __init__(self, text):
+        self.text = text
+    def __repr__(self):
+        return self.text
+
+def schema_signature(method):
+    """Build an inspect.Signature from a method's schema."""
+    parameters = []
+    for param in method["params"]:
+        default = inspect.Parameter.empty
+        if "default" in param:
+            default = param["default"]
+        elif "default_repr" in param:
+            default = DefaultRepr(param["default_repr"])
+        parameters.append(inspect.Parameter(param["name"], getattr(inspect.Parameter, param["kind"]),
+                                            default=default))
+    return inspect.Signature(parameters)
+
+def schema_url_path(path):
+    return path.split("?")[0].rstrip("/") + "/.schema"
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one server, safe to share between threads.
+       size: Maximum number of idle connections kept open.
+       timeout: Socket timeout in seconds."""
+    def __init__(self, url, size=10, timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def open(self, method, path, body, headers):
+        """Send a request and return the connection and the response."""
+        while True:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            reused = connection != None
+            if not reused:
+                connection = self.connect()
+            try:
+                connection.request(method, path, body, headers)
+                return connection, connection.getresponse()
+            except ConnectionError:
+                connection.close()
+                # The server may have closed an idle connection.
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+
+    def release(self, connection, response):
+        """Keep a connection whose response has been read for reuse."""
+        if not response.will_close:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(connection)
+                    return
+        connection.close()
+
+    def check(self, response, data):
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(self.url, response.status, response.reason,
+                                         response.headers, io.BytesIO(data))
+
+    def request(self, method, path, body, headers):
+        """Send a request and return the response body and headers.
+           Raises urllib.error.HTTPError if the server returns an error status."""
+        connection, response = self.open(method, path, body, headers)
+        try:
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self.release(connection, response)
+        self.check(response, data)
+        return data, response.headers
+
+    def stream(self, method, path, body, headers):
+        """Send a request and return the response headers and an iterator
+           over the lines of the response body as they arrive."""
+        connection, response = self.open(method, path, body, headers)
+        if not 200 <= response.status < 300:
+            data = response.read()
+            self.release(connection, response)
+            self.check(response, data)
+
+        def lines():
+            done = False
+            try:
+                for line in response:
+                    yield line
+                # Mark the response finished so the connection can send another request.
+                response.close()
+                done = True
+            finally:
+                if done:
+                    self.release(connection, response)
+                else:
+                    connection.close()
+        return response.headers, lines()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            connection.close()
+
+class AsyncConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one server for asyncio.
+       limit: Maximum number of requests in flight, and of connections.
+       timeout: Time limit for each request in seconds."""
+    def __init__(self, url, limit=10, timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.host_header = parts.netloc.rpartition("@")[2]
+        self.limit = limit
+        self.timeout = timeout
+        self.idle = []
+        self.semaphore = None
+
+    async def request(self, method, path, body, headers):
+        """Send a request and return the response body and headers.
+           Raises urllib.error.HTTPError if the server returns an error status."""
+        if self.semaphore == None:
+            # Created here so that it belongs to the running event loop.
+            self.semaphore = asyncio.Semaphore(self.limit)
+        async with self.semaphore:
+            return await asyncio.wait_for(self.exchange(method, path, body, headers), self.timeout)
+
+    async def open(self, method, path, body, headers):
+        """Send a request and return the connection, status, reason, headers
+           and whether the connection can be reused after the body is read."""
+        request = [method + " " + path + " HTTP/1.1", "Host: " + self.host_header]
+        if body != None:
+            request.append("Content-Length: " + str(len(body)))
+        request.extend(key + ": " + value for key, value in headers.items())
+        request = ("\r\n".join(request) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, reason, response_headers, keep_alive = await self.read_head(reader)
+                return (reader, writer), status, reason, response_headers, keep_alive
+            except ConnectionError:
+                writer.close()
+                # The server may have closed an idle connection.
+                if not reused:
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+
+    async def exchange(self, method, path, body, headers):
+        connection, status, reason, response_headers, keep_alive = await self.open(method, path, body, headers)
+        try:
+            data = b"".join([part async for part in self.read_body(connection[0], response_headers)])
+        except BaseException:
+            connection[1].close()
+            raise
+        self.release(connection, keep_alive)
+        if not 200 <= status < 300:
+            raise urllib.error.HTTPError(self.url, status, reason, response_headers, io.BytesIO(data))
+        return data, response_headers
+
+    async def stream(self, method, path, body, headers):
+        """Send a request, yielding the response headers and then the parts
+           of the response body as they arrive."""
+        if self.semaphore == None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        async with self.semaphore:
+            connection, status, reason, response_headers, keep_alive = await asyncio.wait_for(
+                self.open(method, path, body, headers), self.timeout)
+            done = False
+            try:
+                if not 200 <= status < 300:
+                    data = b"".join([part async for part in self.read_body(connection[0], response_headers)])
+                    raise urllib.error.HTTPError(self.url, status, reason, response_headers, io.BytesIO(data))
+                yield response_headers
+                parts = self.read_body(connection[0], response_headers)
+                while True:
+                    try:
+                        part = await asyncio.wait_for(parts.__anext__(), self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    yield part
+                done = True
+            finally:
+                if done:
+                    self.release(connection, keep_alive)
+                else:
+                    connection[1].close()
+
+    def release(self, connection, keep_alive):
+        if keep_alive:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def read_head(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("The server closed the connection.")
+        version, status, reason = (line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = http.client.HTTPMessage()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip()] = value.strip()
+        connection = headers.get("Connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        if "Content-Length" not in headers and headers.get("Transfer-Encoding", "").lower() != "chunked":
+            # The body ends when the connection is closed.
+            keep_alive = False
+        return int(status), reason, headers, keep_alive
+
+    async def read_body(self, reader, headers):
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                yield await reader.readexactly(size)
+                await reader.readline()
+        elif "Content-Length" in headers:
+            remaining = int(headers["Content-Length"])
+            while remaining > 0:
+                part = await reader.readexactly(min(remaining, 65536))
+                remaining -= len(part)
+                yield part
+        else:
+            while True:
+                part = await reader.read(65536)
+                if not part:
+                    return
+                yield part
+
+    async def close(self):
+        idle = self.idle
+        self.idle = []
+        for reader, writer in idle:
+            writer.close()
+
 class api:
-    def __init__(self, url, token=None):
+    """Client for a SimpleWebAPI server. Connections are kept open and reused,
+       and the client may be shared between threads. Methods are looked up
+       when they are first used, so creating a client makes no requests.
+       codec: Wire encoding, "json", "msgpack" (needs msgpack) or "cbor" (needs cbor2).
+       timeout: Socket timeout in seconds.
+       pool_size: Maximum number of idle connections kept open.
+       schema_cache: File to keep the server's schema in. Methods are bound with
+           their signatures from it, and it is refreshed when the server's
+           schema hash no longer matches."""
+    def __init__(self, url, token=None, codec="json", timeout=60, pool_size=10, schema_cache=None):
         self.url = url
         self.token = token
-        self.gen_methods()
+        self.set_codec(codec)
+        self.pool = ConnectionPool(url, pool_size, timeout)
+        self.schema_cache = schema_cache
+        self.schema_hash = None
+        self.fetched_hash = None
+        self.load_schema()
 
-    def _call_method(self, method, *args, **kwargs):
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        self._register_method(name)
+        return self.__dict__[name]
+
+    def set_codec(self, codec):
+        if codec == "msgpack":
+            import msgpack
+            self.content_type = "application/msgpack"
+            self.dumps = lambda value: msgpack.packb(value, use_bin_type=True)
+            self.loads = lambda data: msgpack.unpackb(data, raw=False)
+        elif codec == "cbor":
+            import cbor2
+            self.content_type = "application/cbor"
+            self.dumps = cbor2.dumps
+            self.loads = cbor2.loads
+        else:
+            self.content_type = "application/json"
+            self.dumps = lambda value: json.dumps(value).encode('utf8')
+            self.loads = lambda data: json.loads(data.decode('utf-8'))
+
+    def _headers(self):
+        return {"Content-Type":self.content_type, "Accept":self.content_type}
+
+    def _post(self, body):
+        data, headers = self.pool.request("POST", self.pool.path, self.dumps(body), self._headers())
+        if self._schema_changed(headers):
+            self.update_schema()
+        return self.loads(data)
+
+    def _make_call(self, method, args, kwargs):
         call = {"method":method,
                     "args":args,
                     "kwargs":kwargs,
                     "version":2}
         if (self.token != None):
             call["token"] = self.token
-        request = urllib.request.Request(self.url,
-                data=json.dumps(call).encode('utf8'),
-                headers={"Content-Type":"application/json"},
-                method="POST")
-        result = json.loads(urllib.request.urlopen(request).read().decode('utf-8'))
+        return call
+
+    def _make_batch(self, calls):
+        return [self._make_call(method,
+                                list(rest[0]) if len(rest) > 0 else [],
+                                rest[1] if len(rest) > 1 else {})
+                for method, *rest in calls]
+
+    def _result(self, result):
         if not result["success"]:
             raise SimpleWebAPIError(message=result.get("error_message"), error_name=result.get("error"))
         return result["result"]
 
-    def _register_method(self, method_name):
+    def _batch_results(self, results):
+        if not isinstance(results, list):
+            raise SimpleWebAPIError(message=results.get("error_message"), error_name=results.get("error"))
+        return [result["result"] if result["success"] else
+                SimpleWebAPIError(message=result.get("error_message"), error_name=result.get("error"))
+                for result in results]
+
+    def _call_method(self, method, *args, **kwargs):
+        return self._result(self._post(self._make_call(method, args, kwargs)))
+
+    def call_batch(self, calls):
+        """Call several methods in one request.
+           calls is a list of (method, args, kwargs) tuples. Returns a list holding
+           the result of each call, or the SimpleWebAPIError it raised."""
+        return self._batch_results(self._post(self._make_batch(calls)))
+
+    def _stream_headers(self):
+        return {"Content-Type":self.content_type, "Accept":"application/x-ndjson, " + self.content_type}
+
+    def _stream_record(self, line):
+        """Return the record of an item on a line of a streamed result,
+           or None for the line that ends it."""
+        record = json.loads(line)
+        if "result" in record:
+            return record
+        if not record["success"]:
+            raise SimpleWebAPIError(message=record.get("error_message"), error_name=record.get("error"))
+        return None
+
+    def call_stream(self, method, *args, **kwargs):
+        """Call a method that returns a generator, yielding the items of its
+           result as they arrive instead of waiting for all of them."""
+        headers, lines = self.pool.stream("POST", self.pool.path,
+                                          self.dumps(self._make_call(method, args, kwargs)),
+                                          self._stream_headers())
+        if not headers.get("Content-Type", "").startswith("application/x-ndjson"):
+            yield from self._result(self.loads(b"".join(lines)))
+            return
+        for line in lines:
+            record = self._stream_record(line)
+            if record != None:
+                yield record["result"]
+
+    def _make_wrapper(self, method_name):
         def method_wrapper(*args, **kwargs):
             return self._call_method(method_name, *args, **kwargs)
+        return method_wrapper
+
+    def _register_method(self, method_name, method=None):
+        method_wrapper = self._make_wrapper(method_name)
+        method_wrapper.__name__ = method_name
+        if method:
+            method_wrapper.__signature__ = schema_signature(method)
+            if method["require"] != None:
+                method_wrapper.__doc__ = "Requires the " + method["require"] + " capability."
         setattr(self, method_name, method_wrapper)
 
     def gen_methods(self):
+        """Bind every method the server has now, instead of when first used."""
         methods = self._call_method("getMethods")
         for method in methods:
             self._register_method(method)
+
+    def _schema_changed(self, headers):
+        """Whether to download the schema. Each server hash is only fetched
+           once, even if the schema it names could not be bound."""
+        server_hash = headers.get("X-SWA-Schema")
+        if not self.schema_cache or not server_hash or server_hash in (self.schema_hash, self.fetched_hash):
+            return False
+        self.fetched_hash = server_hash
+        return True
+
+    def _bind_schema(self, schema):
+        if schema.get("version") != schema_version or schema.get("hash") != schema_hash(schema["methods"]):
+            return False
+        for name, method in schema["methods"].items():
+            self._register_method(name, method)
+        self.schema_hash = schema["hash"]
+        return True
+
+    def load_schema(self):
+        """Bind methods from the schema cache file, if it holds a valid schema."""
+        if not self.schema_cache:
+            return
+        try:
+            with open(self.schema_cache) as f:
+                self._bind_schema(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    def _save_schema(self, data):
+        schema = json.loads(data.decode('utf-8'))
+        if self._bind_schema(schema) and self.schema_cache:
+            temp_file = self.schema_cache + "." + str(os.getpid()) + ".tmp"
+            with open(temp_file, "wb") as f:
+                f.write(data)
+            os.replace(temp_file, self.schema_cache)
+        return schema
+
+    def update_schema(self):
+        """Download the server's schema, bind its methods and save it to the cache file."""
+        data, headers = self.pool.request("GET", schema_url_path(self.pool.path), None, {"Accept":"application/json"})
+        return self._save_schema(data)
+
+    def close(self):
+        """Close idle connections."""
+        self.pool.close()
+
+class async_api(api):
+    """asyncio client for a SimpleWebAPI server. Methods are coroutines,
+       and at most limit calls are sent at once:
+
+           async with swac.async_api(url) as server:
+               users = await asyncio.gather(*[server.get_user(name) for name in names])"""
+    def __init__(self, url, token=None, codec="json", timeout=60, limit=10, schema_cache=None):
+        self.url = url
+        self.token = token
+        self.set_codec(codec)
+        self.pool = AsyncConnectionPool(url, limit, timeout)
+        self.schema_cache = schema_cache
+        self.schema_hash = None
+        self.fetched_hash = None
+        self.load_schema()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _post(self, body):
+        data, headers = await self.pool.request("POST", self.pool.path, self.dumps(body), self._headers())
+        if self._schema_changed(headers):
+            await self.update_schema()
+        return self.loads(data)
+
+    async def _call_method(self, method, *args, **kwargs):
+        return self._result(await self._post(self._make_call(method, args, kwargs)))
+
+    async def call_batch(self, calls):
+        """Call several methods in one request.
+           calls is a list of (method, args, kwargs) tuples. Returns a list holding
+           the result of each call, or the SimpleWebAPIError it raised."""
+        return self._batch_results(await self._post(self._make_batch(calls)))
+
+    async def call_stream(self, method, *args, **kwargs):
+        """Call a method that returns a generator, yielding the items of its
+           result as they arrive instead of waiting for all of them."""
+        parts = self.pool.stream("POST", self.pool.path,
+                                 self.dumps(self._make_call(method, args, kwargs)),
+                                 self._stream_headers())
+        try:
+            headers = await parts.__anext__()
+            if not headers.get("Content-Type", "").startswith("application/x-ndjson"):
+                for item in self._result(self.loads(b"".join([part async for part in parts]))):
+                    yield item
+                return
+            buffer = b""
+            async for part in parts:
+                lines = (buffer + part).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    record = self._stream_record(line)
+                    if record != None:
+                        yield record["result"]
+        finally:
+            await parts.aclose()
+
+    def _make_wrapper(self, method_name):
+        async def method_wrapper(*args, **kwargs):
+            return await self._call_method(method_name, *args, **kwargs)
+        return method_wrapper
+
+    async def gen_methods(self):
+        """Bind every method the server has now, instead of when first used."""
+        methods = await self._call_method("getMethods")
+        for method in methods:
+            self._register_method(method)
+
+    async def update_schema(self):
+        """Download the server's schema, bind its methods and save it to the cache file."""
+        data, headers = await self.pool.request("GET", schema_url_path(self.pool.path), None,
+                                                {"Accept":"application/json"})
+        return self._save_schema(data)
+
+    async def close(self):
+        """Close idle connections."""
+        await self.pool.close()
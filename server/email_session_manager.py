@@ -1,12 +1,262 @@
+import base64
 import binascii
+import json
 import os
+import queue
 import time
-import requests
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, select, and_, inspect, update
+from sqlalchemy import create_engine, Table, Column, Index, Integer, String, MetaData, ForeignKey, select, and_, inspect, update, bindparam
+from sqlalchemy.exc import DBAPIError
 from contextlib import contextmanager
 import hashlib
 import hmac
-from swa import ClassAPI
+import threading
+import traceback
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from swa import ClassAPI, SimpleWebAPIError
+from swa_mail import MailQueue, MailgunTransport
+
+# Version of the schema created by gen_db_schema. Existing databases are
+# brought up to date by migrations/migrate.py.
+SCHEMA_VERSION = 5
+
+# Iteration count of OTP hashes stored without their parameters.
+LEGACY_OTP_ITERATIONS = 100000
+
+# The tables at SCHEMA_VERSION. These are used as declared when the database
+# is at that version, so only older databases need to be reflected.
+metadata = MetaData()
+Table("users", metadata,
+      Column('id', Integer, primary_key=True),
+      Column('username', String(320)),
+      Column('role', String(25)),
+      Column('token_generation', Integer, nullable=False, server_default="0"),
+      Index('ix_users_username', 'username', unique=True),
+)
+Table("tokens", metadata,
+      Column('id', Integer, primary_key=True),
+      Column('user_id', None, ForeignKey('users.id')),
+      Column('token', String(64), nullable=False),
+      Column('expire', Integer),
+      Index('ix_tokens_token', 'token', unique=True),
+      Index('ix_tokens_user_id', 'user_id'),
+      Index('ix_tokens_expire', 'expire'),
+)
+Table("challenges", metadata,
+      Column('id', Integer, primary_key=True),
+      Column('user_id', None, ForeignKey('users.id')),
+      Column('otp', String(128), nullable=False),
+      Column('expire', Integer, nullable=False),
+      Column('token', String(64), nullable=False),
+      Index('ix_challenges_token', 'token'),
+      Index('ix_challenges_expire', 'expire'),
+)
+Table("revocations", metadata,
+      Column('id', Integer, primary_key=True),
+      Column('user_id', None, ForeignKey('users.id'), nullable=False),
+      Column('token_id', String(16)),
+      Column('generation', Integer),
+      Column('role', String(25)),
+      Column('expire', Integer, nullable=False),
+      Index('ix_revocations_expire', 'expire'),
+)
+# Prefixed, as the database may be shared with other tools that keep a
+# schema_version table of their own.
+schema_version = Table("swa_schema_version", metadata,
+      Column('version', Integer, nullable=False),
+)
+
+# Tables that must exist for the session manager to run.
+required_tables = ("users", "tokens", "challenges")
+
+# Databases, by URL, already found to be at SCHEMA_VERSION in this process.
+verified_databases = set()
+
+class HashPool:
+    """Run OTP hashing on a bounded thread pool.
+       hashlib releases the GIL while hashing, so at most workers hashes
+       use CPU at once. Once workers+backlog hashes are pending, further
+       requests fail immediately with ServerBusy."""
+    def __init__(self, workers=2, backlog=8):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="swa-hash")
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+
+    @contextmanager
+    def reserve(self):
+        """Take a slot for one hash, yielding a function that runs it."""
+        if not self.slots.acquire(blocking=False):
+            raise SimpleWebAPIError("ServerBusy", "Too many logins are being processed. Try again later.")
+        try:
+            yield lambda function, *args: self.executor.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def run(self, function, *args):
+        with self.reserve() as run:
+            return run(function, *args)
+
+def pbkdf2_hex(otp, token, iterations):
+    return binascii.b2a_hex(hashlib.pbkdf2_hmac('sha256', bytes(otp, 'ascii'),
+        bytes(token, 'ascii'), iterations)).decode('ascii')
+
+class SessionCache:
+    """Bounded LRU cache mapping token HMACs to identities.
+       Entries expire after ttl seconds, which bounds how long changes made
+       by other processes can go unnoticed. Changes made in this process
+       are invalidated immediately."""
+    def __init__(self, size=10000, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.user_tokens = defaultdict(set)
+        self.lock = threading.Lock()
+        # Incremented by invalidations, so identities read before them are not stored.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, token_crypt):
+        entry = self.entries.pop(token_crypt, None)
+        if entry:
+            user = entry[1]["user"]
+            self.user_tokens[user].discard(token_crypt)
+            if not self.user_tokens[user]:
+                del self.user_tokens[user]
+
+    def get(self, token_crypt):
+        with self.lock:
+            entry = self.entries.get(token_crypt)
+            if entry and entry[0] < time.monotonic():
+                self._remove(token_crypt)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token_crypt)
+            self.hits += 1
+            return entry[1]
+
+    def get_user(self, user):
+        """Return a live cached identity for user, or None."""
+        with self.lock:
+            now = time.monotonic()
+            for token_crypt in self.user_tokens.get(user, ()):
+                entry = self.entries[token_crypt]
+                if entry[0] >= now:
+                    return entry[1]
+        return None
+
+    def put(self, token_crypt, identity, generation):
+        """Store an identity read when the cache was at generation."""
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._remove(token_crypt)
+            self.entries[token_crypt] = (time.monotonic() + self.ttl, identity)
+            self.user_tokens[identity["user"]].add(token_crypt)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_token(self, token_crypt):
+        with self.lock:
+            self.generation += 1
+            self._remove(token_crypt)
+
+    def invalidate_user(self, user):
+        with self.lock:
+            self.generation += 1
+            for token_crypt in list(self.user_tokens.get(user, ())):
+                self._remove(token_crypt)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.user_tokens.clear()
+
+    def stats(self):
+        return {"hits":self.hits,
+                "misses":self.misses,
+                "entries":len(self.entries)}
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class RevocationList:
+    """In-memory copy of the revocations table, checked when verifying
+       signed tokens. Rows revoke one token by id, revoke all of a user's
+       tokens below a generation, or change the role of a user's tokens.
+       Each refresh reads the rows after the last one seen, along with the
+       overlap ids before it, since rows may commit after rows with higher
+       ids. Rows are dropped once every token they apply to has expired."""
+    def __init__(self, overlap=1000):
+        self.tokens = {}
+        self.generations = {}
+        self.roles = {}
+        self.last_id = 0
+        self.overlap = overlap
+        # Ids of the rows read by the last refresh.
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def add(self, row):
+        expire = row["expire"]
+        with self.lock:
+            if row["token_id"] != None:
+                self.tokens[row["token_id"]] = expire
+            if row["generation"] != None:
+                current = self.generations.get(row["user_id"])
+                if not current or current[0] <= row["generation"]:
+                    self.generations[row["user_id"]] = (row["generation"], expire)
+            if row["role"] != None:
+                self.roles[row["user_id"]] = (row["role"], expire)
+            if row.get("id"):
+                self.last_id = max(self.last_id, row["id"])
+
+    def refresh(self, database, table):
+        """Read rows added to table since the last refresh. Returns the number
+           of rows not seen before."""
+        now = time.time()
+        with database.begin() as conn:
+            rows = [dict(x._mapping) for x in conn.execute(select(table.c)
+                    .where(and_(table.c.id > self.last_id - self.overlap, table.c.expire > now))
+                    .order_by(table.c.id))]
+        # Rows are only applied once, and a role is only applied if it is the
+        # user's latest, so late rows do not replace newer roles.
+        latest = {row["user_id"]:row["id"] for row in rows if row["role"] != None}
+        new = [row for row in rows if row["id"] not in self.seen]
+        for row in new:
+            if row["role"] != None and latest[row["user_id"]] != row["id"]:
+                row["role"] = None
+            self.add(row)
+        self.seen = set(row["id"] for row in rows)
+        with self.lock:
+            for key in [key for key, expire in self.tokens.items() if expire < now]:
+                del self.tokens[key]
+            for entries in (self.generations, self.roles):
+                for key in [key for key, value in entries.items() if value[1] < now]:
+                    del entries[key]
+        return len(new)
+
+    def check(self, user_id, token_id, generation, role):
+        """Return the current role for a token, or None if it was revoked."""
+        if token_id in self.tokens:
+            return None
+        current = self.generations.get(user_id)
+        if current and generation < current[0]:
+            return None
+        current = self.roles.get(user_id)
+        return current[0] if current else role
+
+    def stats(self):
+        return {"tokens":len(self.tokens),
+                "generations":len(self.generations),
+                "roles":len(self.roles)}
 
 class EmailSessionManager:
     capi = ClassAPI()
@@ -21,15 +271,39 @@ class EmailSessionManager:
         self.roles = {}
         self.admin_email = None
         self.admin_user = None
+        self.session_cache_size = 10000
+        self.session_cache_ttl = 30
+        self.session_cache = SessionCache(self.session_cache_size, self.session_cache_ttl)
+        self.mail_transport = None
+        self.mail_workers = 2
+        self.mail_backlog = 1000
+        self.mail_retries = 3
+        self.mail_queue = None
+        self.otp_iterations = 100000
+        self.hash_workers = 2
+        self.hash_backlog = 8
+        self.hash_pool = HashPool(self.hash_workers, self.hash_backlog)
+        self.token_ttl = 31557600
+        self.token_renew_interval = 86400
+        self.reap_interval = 300
+        self.reap_batch_size = 1000
+        self.max_page_size = 1000
+        self.bulk_chunk_size = 500
+        self.token_format = "opaque"
+        self.token_secret = None
+        self.revocation_refresh = 5
+        self.revocations = RevocationList()
+        self.revocation_refresher = None
+        self.reaper = None
+        self.reaper_stats = {"passes":0, "challenges":0, "tokens":0, "last_duration":None}
 
-        if not self.check_db_schema():
-            self.gen_db_schema()
-
-        self.metadata = MetaData()
-        self.metadata.reflect(self.database)
+        self.metadata = self.load_db_schema()
+        self.prepare_statements()
 
         api.set_capability_handler(self.get_capabilities)
         api.set_token_lookup_handler(self.check_token)
+        api.set_identity_handler(self.resolve_token)
+        api.metrics.add_collector(self.collect_metrics)
 
         EmailSessionManager.capi.commit(self, api)
 
@@ -42,62 +316,174 @@ class EmailSessionManager:
                 bytes(token,'ascii'), hashlib.sha256).hexdigest()
 
     def gen_token(self, user):
+        uid = self.get_or_register_user(user)
+        if self.token_format == "signed":
+            return self.gen_signed_token(uid)
         token = binascii.b2a_hex(os.urandom(32)).decode('UTF-8')
-        user_info = self.get_user(user)
-        if not user_info:
-            self.register_user(user, self.default_role)
-            user_info = self.get_user(user)
-        tokens = self.metadata.tables['tokens']
         token_crypt = self.token_hmac(token)
-        ins = tokens.insert().values(user_id=user_info['id'], token=token_crypt)
         with self.database.begin() as conn:
-            conn.execute(ins)
+            conn.execute(self.token_insert, {"user_id":uid, "token":token_crypt,
+                                             "expire":int(time.time() + self.token_ttl)})
         return token
 
+    def token_signature(self, payload):
+        return hmac.new(bytes(self.token_secret, 'utf-8'), bytes(payload, 'ascii'), hashlib.sha256).digest()
+
+    def gen_signed_token(self, uid):
+        """Make a token holding the user's id, name, role and token generation,
+           signed with token_secret, which can be checked without the database."""
+        users = self.metadata.tables['users']
+        with self.database.begin() as conn:
+            row = conn.execute(select(users.c.username, users.c.role, users.c.token_generation)
+                               .where(users.c.id == uid)).fetchone()
+        now = int(time.time())
+        payload = b64encode(json.dumps([uid, row[0], row[1], row[2] or 0, now, now + self.token_ttl,
+                                        binascii.b2a_hex(os.urandom(8)).decode('ascii')],
+                                       separators=(",", ":")).encode('utf-8'))
+        return "s." + payload + "." + b64encode(self.token_signature(payload))
+
+    def decode_signed_token(self, token):
+        """Return the fields of a signed token if its signature is valid
+           and it has not expired, otherwise None."""
+        if not self.token_secret:
+            return None
+        try:
+            prefix, payload, signature = token.split(".")
+            if not hmac.compare_digest(b64decode(signature), self.token_signature(payload)):
+                return None
+            uid, user, role, generation, issued, expire, token_id = json.loads(b64decode(payload))
+        except (ValueError, TypeError, binascii.Error):
+            return None
+        if expire <= time.time():
+            return None
+        return {"user_id":uid, "user":user, "role":role, "generation":generation,
+                "issued":issued, "expire":expire, "token_id":token_id}
+
+    def resolve_signed_token(self, token):
+        fields = self.decode_signed_token(token)
+        if not fields:
+            return None
+        role = self.revocations.check(fields["user_id"], fields["token_id"], fields["generation"], fields["role"])
+        if role == None:
+            return None
+        return {"user":fields["user"],
+                "user_id":fields["user_id"],
+                "role":role,
+                "capabilities":self.roles.get(role)}
+
+    def revoke(self, rows):
+        """Add rows to the revocations table, and apply them in this process
+           straight away. Does nothing when signed tokens are not enabled."""
+        if not self.token_secret or not rows:
+            return
+        for row in rows:
+            for key in ("token_id", "generation", "role"):
+                row.setdefault(key, None)
+        with self.database.begin() as conn:
+            conn.execute(self.metadata.tables['revocations'].insert(), rows)
+        for row in rows:
+            self.revocations.add(row)
+
+    def refresh_revocations(self):
+        return self.revocations.refresh(self.database, self.metadata.tables['revocations'])
+
+    def revocation_loop(self):
+        while True:
+            try:
+                self.refresh_revocations()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.revocation_refresh)
+
+    def prepare_statements(self):
+        """Build the statements run on every request once, with bound
+           parameters, so each call only supplies the values."""
+        users = self.metadata.tables['users']
+        tokens = self.metadata.tables['tokens']
+        challenges = self.metadata.tables['challenges']
+        self.token_insert = tokens.insert()
+        self.user_select = select(users.c).where(users.c.username == bindparam("username"))
+        self.identity_select = (select(users.c.id, users.c.username, users.c.role, tokens.c.expire)
+            .select_from(tokens.join(users))
+            .where(and_(tokens.c.token == bindparam("token_crypt"),
+                   tokens.c.expire > bindparam("now"))))
+        self.token_renew = (tokens.update()
+            .where(tokens.c.token == bindparam("token_crypt"))
+            .values(expire=bindparam("expire")))
+        self.token_delete = tokens.delete().where(tokens.c.token == bindparam("token_crypt"))
+        self.user_tokens_delete = tokens.delete().where(tokens.c.user_id == bindparam("uid"))
+        self.challenge_select = (select(challenges.c.token, challenges.c.otp, challenges.c.id)
+            .select_from(challenges.join(users))
+            .where(and_(challenges.c.token == bindparam("token_crypt"),
+                   users.c.username == bindparam("username"),
+                   challenges.c.expire > bindparam("now"))))
+        self.challenge_delete = challenges.delete().where(challenges.c.token == bindparam("token_crypt"))
+
+    def get_db_version(self):
+        """Return the version in the swa_schema_version table, or None if there is none."""
+        try:
+            with self.database.begin() as conn:
+                row = conn.execute(select(schema_version.c.version)).fetchone()
+        except DBAPIError:
+            return None
+        return row[0] if row else None
+
+    def load_db_schema(self):
+        """Return the metadata of the session tables, creating them if needed.
+           A database at SCHEMA_VERSION is checked with one query and uses the
+           declared tables. Older databases must be brought up to date with
+           the migrations first."""
+        url = str(self.database.url)
+        if url in verified_databases:
+            return metadata
+        version = self.get_db_version()
+        if version == SCHEMA_VERSION:
+            verified_databases.add(url)
+            return metadata
+        if not self.check_db_schema():
+            self.gen_db_schema()
+            verified_databases.add(url)
+            return metadata
+        found = "are at version " + str(version) if version != None else "have no recorded version"
+        raise RuntimeError("Session tables " + found + ", but version " + str(SCHEMA_VERSION) +
+                           " is required. Run migrations/migrate.py.")
+
     def check_db_schema(self):
-        return (inspect(self.database).has_table("tokens") and
-            inspect(self.database).has_table("users") and
-            inspect(self.database).has_table("challenges"))
+        names = inspect(self.database).get_table_names()
+        return all(name in names for name in required_tables)
 
     def gen_db_schema(self):
-        metadata = MetaData()
-        Table("users", metadata,
-              Column('id', Integer, primary_key=True),
-              Column('username', String(320)),
-              Column('role', String(25)),
-        )
-        Table("tokens", metadata,
-              Column('id', Integer, primary_key=True),
-              Column('user_id', None, ForeignKey('users.id')),
-              Column('token', String(64), nullable=False),
-        )
-        Table("challenges", metadata,
-              Column('id', Integer, primary_key=True),
-              Column('user_id', None, ForeignKey('users.id')),
-              Column('otp', String(64), nullable=False),
-              Column('expire', Integer, nullable=False),
-              Column('token', String(64), nullable=False),
-        )
         metadata.create_all(self.database)
+        with self.database.begin() as conn:
+            if not conn.execute(schema_version.update().values(version=SCHEMA_VERSION)).rowcount:
+                conn.execute(schema_version.insert().values(version=SCHEMA_VERSION))
+
+    def set_mail_transport(self, transport):
+        """Use transport, an object with a send(recipient, subject, text)
+           method, to deliver email instead of Mailgun."""
+        self.mail_transport = transport
+        if self.mail_queue:
+            self.mail_queue.transport = transport
 
     def send_email(self, recipient, subject, text):
         if self.print_debug:
             print("To: "+recipient+"\nSubject: "+subject+"\nMessage: "+text)
-        else:
-            return requests.post(
-            "https://api.mailgun.net/v3/"+self.domain+"/messages",
-            auth=("api", self.mailgun_key),
-            data={"from": "No Reply <"+self.email+"@"+self.domain+">",
-                  "to": [recipient],
-                  "subject": subject,
-                  "text": text})
+            return
+        if not self.mail_queue:
+            if not self.mail_transport:
+                self.mail_transport = MailgunTransport(self.domain, self.mailgun_key,
+                        "No Reply <"+self.email+"@"+self.domain+">")
+            self.mail_queue = MailQueue(self.mail_transport, workers=self.mail_workers,
+                    max_backlog=self.mail_backlog, retries=self.mail_retries)
+        try:
+            self.mail_queue.send(recipient, subject, text)
+        except queue.Full:
+            raise SimpleWebAPIError("MailQueueFull", "Too many emails are waiting to be sent. Try again later.")
 
     @capi.add(require="accountmanager")
     def get_user(self, username):
-        users = self.metadata.tables['users']
-        s = select(users.c).where(users.c.username == username)
         with self.database.begin() as conn:
-            result = conn.execute(s)
+            result = conn.execute(self.user_select, {"username":username})
             row = result.fetchone()
             result.close()
         if not row:
@@ -105,38 +491,77 @@ class EmailSessionManager:
         else:
             return row._mapping
 
-    def check_token(self, token):
+    def resolve_token(self, token):
+        """Resolve a token to its user, user id, role and capabilities.
+           Uses the session cache or a single query."""
+        if token == None:
+            return None
+        if token.startswith("s."):
+            return self.resolve_signed_token(token)
+        token_crypt = self.token_hmac(token)
+        generation = self.session_cache.generation
+        identity = self.session_cache.get(token_crypt)
+        if identity:
+            return identity
         users = self.metadata.tables['users']
         tokens = self.metadata.tables['tokens']
-        token_crypt = self.token_hmac(token)
-        s = (select(users.c.username, tokens.c.token)
-            .select_from(tokens.join(users))
-            .where(tokens.c.token == token_crypt))
+        now = time.time()
         with self.database.begin() as conn:
-            result = conn.execute(s)
+            result = conn.execute(self.identity_select, {"token_crypt":token_crypt, "now":now})
             row = result.fetchone()
             result.close()
-        if not row:
+            if not row:
+                return None
+            # Sliding expiry, renewed at most once per token_renew_interval.
+            if row._mapping[tokens.c.expire] < now + self.token_ttl - self.token_renew_interval:
+                conn.execute(self.token_renew, {"token_crypt":token_crypt,
+                                                "expire":int(now + self.token_ttl)})
+        role = row._mapping[users.c.role]
+        identity = {"user":row._mapping[users.c.username],
+                    "user_id":row._mapping[users.c.id],
+                    "role":role,
+                    "capabilities":self.roles.get(role)}
+        self.session_cache.put(token_crypt, identity, generation)
+        return identity
+
+    def check_token(self, token):
+        identity = self.resolve_token(token)
+        if not identity:
             return None
-        else:
-            return row._mapping[users.c.username]
+        return identity["user"]
 
     @capi.add(require=None, details=True)
     def logoff(self, details):
         token = details['token']
-        tokens = self.metadata.tables['tokens']
+        if token and token.startswith("s."):
+            fields = self.decode_signed_token(token)
+            if fields:
+                self.revoke([{"user_id":fields["user_id"], "token_id":fields["token_id"],
+                              "expire":fields["expire"]}])
+            details["token"] = None
+            return
         token_crypt = self.token_hmac(token)
         with self.database.begin() as conn:
-            conn.execute(tokens.delete().where(tokens.c.token == token_crypt))
+            conn.execute(self.token_delete, {"token_crypt":token_crypt})
+        self.session_cache.invalidate_token(token_crypt)
         details["token"] = None
 
     @capi.add(require=None, details=True)
     def logoff_all(self, details):
         user = details['user']
-        uid = self.get_user(user)['id']
-        tokens = self.metadata.tables['tokens']
+        uid = details.get('user_id') or self.get_user(user)['id']
+        users = self.metadata.tables['users']
         with self.database.begin() as conn:
-            conn.execute(tokens.delete().where(tokens.c.user_id == uid))
+            conn.execute(self.user_tokens_delete, {"uid":uid})
+            if self.token_secret:
+                conn.execute(update(users).where(users.c.id == uid)
+                             .values(token_generation=users.c.token_generation + 1))
+                generation = conn.execute(select(users.c.token_generation)
+                                          .where(users.c.id == uid)).scalar()
+        if self.token_secret:
+            self.revoke([{"user_id":uid, "generation":generation,
+                          "expire":int(time.time() + self.token_ttl)}])
+        self.session_cache.invalidate_user(user)
         details["token"] = None
 
     @capi.add(require=None, details=True)
@@ -149,43 +574,48 @@ class EmailSessionManager:
         else:
             return {"success":False, "error":"Code is Invalid"}
 
+    def hash_otp(self, otp, token):
+        """Hash an OTP, returning a string that records the hash parameters."""
+        iterations = self.otp_iterations
+        otp_hash = self.hash_pool.run(pbkdf2_hex, otp, token, iterations)
+        return "pbkdf2_sha256$" + str(iterations) + "$" + otp_hash
+
+    def verify_otp(self, otp, token, otp_crypt, run=None):
+        if "$" in otp_crypt:
+            algorithm, iterations, expected = otp_crypt.split("$")
+            iterations = int(iterations)
+        else:
+            iterations, expected = LEGACY_OTP_ITERATIONS, otp_crypt
+        otp_hash = (run or self.hash_pool.run)(pbkdf2_hex, otp, token, iterations)
+        return hmac.compare_digest(otp_hash, expected)
+
     def check_otp(self, user, otp, token):
-        users = self.metadata.tables['users']
         challenges = self.metadata.tables['challenges']
-        otp_crypt = binascii.b2a_hex(hashlib.pbkdf2_hmac('sha256', bytes(otp, 'ascii'),
-            bytes(token, 'ascii'), 100000)).decode('ascii')
         token_crypt = self.token_hmac(token)
-        s = (select(challenges.c.token, challenges.c.otp, challenges.c.id)
-            .select_from(challenges.join(users))
-            .where(and_(challenges.c.token == token_crypt,
-                   users.c.username == user,
-                   challenges.c.expire > time.time())))
-        with self.database.begin() as conn:
-            result = conn.execute(s)
-            row = result.fetchone()
-            result.close()
-            authorized = False
-            if row:
-                if row._mapping[challenges.c.otp] == otp_crypt:
-                    authorized = True
-                conn.execute(challenges.delete().where(challenges.c.token == token_crypt))
-            conn.execute(challenges.delete().where(challenges.c.expire < time.time()))
-        return authorized
+        # Take the hashing slot before using up the challenge, so that
+        # ServerBusy does not cost the caller their code.
+        with self.hash_pool.reserve() as run:
+            with self.database.begin() as conn:
+                result = conn.execute(self.challenge_select, {"token_crypt":token_crypt, "username":user,
+                                                              "now":time.time()})
+                row = result.fetchone()
+                result.close()
+                if row:
+                    conn.execute(self.challenge_delete, {"token_crypt":token_crypt})
+            if not row:
+                return False
+            return self.verify_otp(otp, token, row._mapping[challenges.c.otp], run)
 
     @capi.add(require=None, details=True)
     def send_otp(self,username,details):
         username = username.lower()
-        user_info = self.get_user(username)
-        if not user_info:
-            self.register_user(username, self.default_role)
-            user_info = self.get_user(username)
+        uid = self.get_or_register_user(username)
         challenges = self.metadata.tables['challenges']
         token = binascii.b2a_hex(os.urandom(32)).decode('UTF-8')
         token_crypt = self.token_hmac(token)
         otp = binascii.b2a_hex(os.urandom(3)).decode('UTF-8')
-        otp_crypt = binascii.b2a_hex(hashlib.pbkdf2_hmac('sha256', bytes(otp, 'ascii'),
-            bytes(token, 'ascii'), 100000)).decode('ascii')
-        ins = challenges.insert().values(user_id=user_info['id'],
+        otp_crypt = self.hash_otp(otp, token)
+        ins = challenges.insert().values(user_id=uid,
                                          token=token_crypt,
                                          otp=otp_crypt,
                                          expire=time.time()+600)
@@ -200,6 +630,11 @@ class EmailSessionManager:
         return token
 
     def get_capabilities(self, user):
+        if user == None:
+            return None
+        identity = self.session_cache.get_user(user)
+        if identity:
+            return identity["capabilities"]
         user_info = self.get_user(user)
         if not user_info:
             return None
@@ -210,10 +645,70 @@ class EmailSessionManager:
         username = username.lower()
         if self.get_user(username) or not username:
             return
+        self.insert_user(username, role)
+
+    def insert_user(self, username, role):
         users = self.metadata.tables['users']
         ins = users.insert().values(username=username, role=role)
         with self.database.begin() as conn:
-            conn.execute(ins)
+            result = conn.execute(ins)
+        return result.inserted_primary_key[0]
+
+    def get_or_register_user(self, username):
+        """Return the id of username, registering it with the default role if needed."""
+        user_info = self.get_user(username)
+        if user_info:
+            return user_info['id']
+        return self.insert_user(username, self.default_role)
+
+    def check_user_roles(self, users):
+        if not all(isinstance(username, str) and isinstance(role, str) for username, role in users.items()):
+            raise SimpleWebAPIError("InvalidArguments", "Usernames and roles must be strings.")
+        return [(username.lower(), role) for username, role in users.items() if username]
+
+    def chunks(self, items):
+        for start in range(0, len(items), self.bulk_chunk_size):
+            yield items[start:start + self.bulk_chunk_size]
+
+    @capi.add(require="accountmanager")
+    def register_users(self, users):
+        """Register users given as {username: role}, skipping existing ones.
+           Returns the number registered."""
+        table = self.metadata.tables['users']
+        registered = 0
+        for chunk in self.chunks(self.check_user_roles(users)):
+            with self.database.begin() as conn:
+                existing = {row[0] for row in conn.execute(select(table.c.username)
+                            .where(table.c.username.in_([username for username, role in chunk])))}
+                rows = [{"username":username, "role":role} for username, role in dict(chunk).items()
+                        if username not in existing]
+                if rows:
+                    conn.execute(table.insert(), rows)
+            registered += len(rows)
+        return registered
+
+    @capi.add(require="accountmanager")
+    def set_user_roles(self, users):
+        """Set the roles of users given as {username: role}, skipping unknown
+           users. Returns the number updated."""
+        table = self.metadata.tables['users']
+        upd = (update(table)
+               .where(table.c.id == bindparam("user_id"))
+               .values(role=bindparam("new_role")))
+        updated = []
+        for chunk in self.chunks(self.check_user_roles(users)):
+            roles = dict(chunk)
+            with self.database.begin() as conn:
+                rows = conn.execute(select(table.c.id, table.c.username)
+                                    .where(table.c.username.in_(list(roles)))).fetchall()
+                if rows:
+                    conn.execute(upd, [{"user_id":row[0], "new_role":roles[row[1]]} for row in rows])
+            updated.extend(row[1] for row in rows)
+            expire = int(time.time() + self.token_ttl)
+            self.revoke([{"user_id":row[0], "role":roles[row[1]], "expire":expire} for row in rows])
+        for username in updated:
+            self.session_cache.invalidate_user(username)
+        return len(updated)
 
     @capi.add(require="accountmanager")
     def set_user_role(self, username, role):
@@ -225,6 +720,9 @@ class EmailSessionManager:
                    .values(role=role))
             with self.database.begin() as conn:
                 conn.execute(upd)
+            self.revoke([{"user_id":user_info['id'], "role":role,
+                          "expire":int(time.time() + self.token_ttl)}])
+            self.session_cache.invalidate_user(user_info['username'])
 
     def recurse_roles(self, roles, role, visited=None):
         if not visited:
@@ -242,20 +740,125 @@ class EmailSessionManager:
             setattr(self, key, value)
         for role in self.roles.keys():
             self.roles[role] = self.recurse_roles(self.roles, role)
+        self.session_cache = SessionCache(self.session_cache_size, self.session_cache_ttl)
+        self.hash_pool = HashPool(self.hash_workers, self.hash_backlog)
+        if self.reap_interval and not self.reaper:
+            self.reaper = threading.Thread(target=self.reaper_loop, name="swa-reaper", daemon=True)
+            self.reaper.start()
+        if self.token_format == "signed" and not self.token_secret:
+            raise ValueError("Signed tokens need a token_secret.")
+        if self.token_secret and self.revocation_refresh and not self.revocation_refresher:
+            self.revocation_refresher = threading.Thread(target=self.revocation_loop,
+                                                         name="swa-revocations", daemon=True)
+            self.revocation_refresher.start()
         if self.admin_user != "":
             self.register_user(self.admin_user, "root")
 
+    def reap_table(self, table, now):
+        """Delete expired rows of table in batches. Returns the number deleted."""
+        removed = 0
+        while True:
+            with self.database.begin() as conn:
+                ids = [row[0] for row in conn.execute(select(table.c.id)
+                       .where(table.c.expire < now)
+                       .limit(self.reap_batch_size))]
+                if ids:
+                    conn.execute(table.delete().where(table.c.id.in_(ids)))
+            removed += len(ids)
+            if len(ids) < self.reap_batch_size:
+                return removed
+
+    def reap(self):
+        """Delete expired challenges and tokens. Returns the rows removed and the time taken."""
+        start = time.monotonic()
+        now = time.time()
+        challenges = self.reap_table(self.metadata.tables['challenges'], now)
+        tokens = self.reap_table(self.metadata.tables['tokens'], now)
+        if 'revocations' in self.metadata.tables:
+            self.reap_table(self.metadata.tables['revocations'], now)
+        duration = time.monotonic() - start
+        stats = self.reaper_stats
+        stats["passes"] += 1
+        stats["challenges"] += challenges
+        stats["tokens"] += tokens
+        stats["last_duration"] = duration
+        return {"challenges":challenges, "tokens":tokens, "duration":duration}
+
+    def collect_metrics(self):
+        """Report session cache, reaper and email statistics to the API metrics."""
+        cache = self.session_cache.stats()
+        metrics = [
+            ("swa_session_cache_hits_total", "counter", "Session cache hits.", [((), cache["hits"])]),
+            ("swa_session_cache_misses_total", "counter", "Session cache misses.", [((), cache["misses"])]),
+            ("swa_session_cache_entries", "gauge", "Sessions in the cache.", [((), cache["entries"])]),
+            ("swa_reaper_passes_total", "counter", "Passes of the expired session reaper.",
+             [((), self.reaper_stats["passes"])]),
+            ("swa_reaped_rows_total", "counter", "Expired rows deleted by the reaper.",
+             [((("table", "challenges"),), self.reaper_stats["challenges"]),
+              ((("table", "tokens"),), self.reaper_stats["tokens"])]),
+        ]
+        if self.reaper_stats["last_duration"] != None:
+            metrics.append(("swa_reaper_last_duration_seconds", "gauge", "Duration of the last reaper pass.",
+                            [((), self.reaper_stats["last_duration"])]))
+        if self.token_secret:
+            revocations = self.revocations.stats()
+            metrics.append(("swa_revocations", "gauge", "Signed token revocations held in memory.",
+                            [((("kind", kind),), count) for kind, count in sorted(revocations.items())]))
+        if self.mail_queue:
+            metrics.append(("swa_mail_total", "counter", "Emails delivered or given up on.",
+                            [((("result", "sent"),), self.mail_queue.sent),
+                             ((("result", "failed"),), self.mail_queue.failed)]))
+            metrics.append(("swa_mail_backlog", "gauge", "Emails waiting to be sent.",
+                            [((), self.mail_queue.queue.qsize())]))
+        return metrics
+
+    def reaper_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                result = self.reap()
+                if self.print_debug and (result["challenges"] or result["tokens"]):
+                    print("Reaped {challenges} challenges and {tokens} tokens in {duration:.3f}s.".format(**result))
+            except Exception:
+                traceback.print_exc()
+
     @capi.add(require="accountmanager")
     def list_roles(self):
         return list(self.roles.keys())
 
-    @capi.add(require="accountmanager")
-    def get_all_users(self):
+    def users_page(self, after_id, limit, role=None, prefix=None):
         users = self.metadata.tables['users']
-        s = select(users.c)
+        s = select(users.c.id, users.c.username, users.c.role).order_by(users.c.id).limit(limit)
+        if after_id != None:
+            s = s.where(users.c.id > after_id)
+        if role != None:
+            s = s.where(users.c.role == role)
+        if prefix:
+            escaped = prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            s = s.where(users.c.username.like(escaped + "%", escape="\\"))
         with self.database.begin() as conn:
-            result = conn.execute(s)
-            response = [dict(x._mapping) for x in result]
-            result.close()
-        return response
+            return [dict(x._mapping) for x in conn.execute(s)]
+
+    @capi.add(require="accountmanager")
+    def list_users(self, after=None, limit=100, role=None, prefix=None):
+        """Return a page of users ordered by id, optionally only those with
+           role or a username starting with prefix. Pass the returned next
+           value as after to get the following page; it is None on the last page."""
+        if not isinstance(limit, int) or limit < 1:
+            raise SimpleWebAPIError("InvalidArguments", "limit must be a positive integer.")
+        limit = min(limit, self.max_page_size)
+        page = self.users_page(after, limit, role, prefix)
+        return {"users":page,
+                "next":page[-1]["id"] if len(page) == limit else None}
+
+    @capi.add(require="accountmanager")
+    def get_all_users(self):
+        # Read a page per transaction, and stream the users to callers that accept it.
+        after = None
+        while True:
+            page = self.users_page(after, self.max_page_size)
+            yield from page
+            if len(page) < self.max_page_size:
+                return
+            after = page[-1]["id"]
 
@@ -9,13 +9,17 @@ setup(
     description="New template for making applications on iwalton.com.",
     license='LGPLv3',
     url="https://github.com/iwalton3/swapi",
-    py_modules=['swa', 'email_session_manager', 'swa_gen_py', 'swa_gen_js'],
+    py_modules=['swa', 'email_session_manager', 'swa_gen_py', 'swa_gen_js', 'swa_mail', 'swa_codecs', 'swa_metrics', 'swa_profile', 'swa_cache', 'swa_limits'],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
-    install_requires=['pymysql', 'sqlalchemy', 'werkzeug']
+    python_requires='>=3.7',
+    install_requires=['pymysql', 'sqlalchemy', 'werkzeug', 'requests'],
+    extras_require={
+        'codecs': ['orjson', 'msgpack', 'cbor2'],
+        'compression': ['brotli'],
+    }
 )
 
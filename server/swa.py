@@ -1,9 +1,26 @@
 from werkzeug.wrappers import Request, Response
+import asyncio
+import inspect
+import io
 import json
+import sys
 import traceback
 import time
 import datetime
+import gzip
+import hashlib
 from collections import defaultdict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import swa_cache
+import swa_codecs
+import swa_limits
+import swa_metrics
+import swa_profile
+try:
+    import brotli
+except ImportError:
+    brotli = None
 import swa_gen_js
 import swa_gen_py
 
@@ -14,89 +31,445 @@ class SimpleWebAPIError(Exception):
     def __str__(self):
         return str(self.error_name) + ": " + str(self.message)
 
+def error_result(ex):
+    return {"success":False,
+            "error":ex.error_name,
+            "error_message":ex.message}
+
+def unknown_method_result(method):
+    return {"success":False,
+            "error":"UnknownMethod",
+            "error_message":"There is no method '" + str(method) + "'."}
+
+def invalid_call_result():
+    return {"success":False,
+            "error":"InvalidCall",
+            "error_message":"Each call in a batch must be an object."}
+
+def batch_too_large_result(max_batch_size):
+    return {"success":False,
+            "error":"BatchTooLarge",
+            "error_message":"At most " + str(max_batch_size) + " calls may be batched."}
+
+def exception_result(method):
+    return {"success":False,
+            "error":"Exception",
+            "error_message":"An exception occured while calling method '" + str(method) + "'."}
+
+stream_content_type = "application/x-ndjson"
+
+def collect_result(method, res):
+    """Turn an iterator result into a list, for callers that cannot stream it."""
+    if not res["success"] or not isinstance(res["result"], Iterator):
+        return res
+    try:
+        return {"success":True,
+                "result":list(res["result"])}
+    except SimpleWebAPIError as ex:
+        return error_result(ex)
+    except Exception:
+        traceback.print_exc()
+        return exception_result(method)
+
+def stream_lines(method, items, dumps):
+    """Encode items as NDJSON lines of {"result":item}, followed by a line
+       holding the outcome of the call, {"success":true} or an error result."""
+    buffer = []
+    size = 0
+    first = True
+    try:
+        for item in items:
+            line = dumps({"result":item}) + b"\n"
+            buffer.append(line)
+            size += len(line)
+            # Send the first item at once, then in blocks of about 64KB.
+            if size >= 65536 or first:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+                first = False
+        end = {"success":True}
+    except SimpleWebAPIError as ex:
+        end = error_result(ex)
+    except Exception:
+        traceback.print_exc()
+        end = exception_result(method)
+    buffer.append(dumps(end) + b"\n")
+    yield b"".join(buffer)
+
+def asgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope so werkzeug can parse it."""
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+            "REQUEST_METHOD":scope["method"],
+            "SCRIPT_NAME":root_path,
+            "PATH_INFO":path,
+            "QUERY_STRING":scope.get("query_string", b"").decode('latin-1'),
+            "SERVER_NAME":server[0],
+            "SERVER_PORT":str(server[1]),
+            "SERVER_PROTOCOL":"HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR":scope["client"][0] if scope.get("client") else None,
+            "CONTENT_LENGTH":str(len(body)),
+            "wsgi.version":(1, 0),
+            "wsgi.url_scheme":scope.get("scheme", "http"),
+            "wsgi.input":io.BytesIO(body),
+            "wsgi.errors":sys.stderr,
+            "wsgi.multithread":True,
+            "wsgi.multiprocess":False,
+            "wsgi.run_once":False,
+            }
+    for name, value in scope.get("headers", []):
+        name = name.decode('latin-1').upper().replace("-", "_")
+        value = value.decode('latin-1')
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ and name != "CONTENT_LENGTH":
+            environ[name] += "," + value
+        else:
+            environ[name] = value
+    return environ
+
+no_capabilities = frozenset()
+
+def not_authorized(name):
+    return SimpleWebAPIError("NotAuthorized", "The current user cannot call method '" + name + "'.")
+
+def overloaded(name):
+    return SimpleWebAPIError("Overloaded", "Too many calls to method '" + name + "'. Try again later.")
+
+def get_not_allowed(name):
+    return SimpleWebAPIError("MethodNotAllowed", "Method '" + name + "' cannot be called with GET.")
+
+def invalid_arguments(name, message):
+    return SimpleWebAPIError("InvalidArguments", "Method '" + name + "' " + message + ".")
+
+# Annotations checked on arguments. float parameters also accept integers.
+checked_types = (bool, int, float, str, list, dict)
+
+profiler_methods = ("startProfile", "stopProfile", "getProfile")
+
+# Version of the format served by the /.schema endpoint.
+schema_version = 1
+
+def method_schema(invoker):
+    """Describe the parameters and required capability of a method."""
+    params = []
+    for parameter in inspect.signature(invoker.method).parameters.values():
+        if parameter.name == "details" and invoker.details:
+            continue
+        param = {"name":parameter.name, "kind":parameter.kind.name}
+        if parameter.default is not parameter.empty:
+            try:
+                json.dumps(parameter.default)
+                param["default"] = parameter.default
+            except (TypeError, ValueError):
+                # Not repr, which can differ between processes and change the hash.
+                param["default_repr"] = "<" + type(parameter.default).__name__ + ">"
+        if parameter.annotation in checked_types:
+            param["type"] = parameter.annotation.__name__
+        params.append(param)
+    return {"params":params, "require":invoker.require, "async":invoker.is_async,
+            "idempotent":invoker.idempotent, "max_age":invoker.max_age}
+
+class MethodInvoker:
+    """A registered API method, with its signature bound ahead of time
+       so calls can be checked without inspecting the function."""
+    __slots__ = ("name", "method", "require", "details", "is_async", "needs_auth",
+                 "positional", "required", "keywords", "var_args", "var_kwargs", "checks",
+                 "fast_args", "metrics", "labels", "cache", "needs_details", "limiter",
+                 "idempotent", "max_age")
+
+    def __init__(self, name, method, require=None, details=False, metrics=None, cache=None, limiter=None,
+                 idempotent=False, max_age=0):
+        self.name = name
+        self.metrics = metrics
+        self.labels = (("method", name),)
+        self.method = method
+        self.require = require
+        self.details = details
+        self.cache = swa_cache.make_cache(cache)
+        self.limiter = limiter
+        self.idempotent = idempotent
+        self.max_age = max_age
+        self.is_async = inspect.iscoroutinefunction(inspect.unwrap(method))
+        self.needs_details = (details or (self.cache != None and self.cache.vary == "user")
+                              or (limiter != None and limiter.key != None))
+        self.needs_auth = require != None or self.needs_details or self.cache != None and self.cache.vary != None
+        self.positional = []
+        self.required = []
+        self.keywords = set()
+        self.var_args = False
+        self.var_kwargs = False
+        self.checks = []
+        for parameter in inspect.signature(method).parameters.values():
+            if parameter.name == "details" and details:
+                continue
+            if parameter.kind == parameter.VAR_POSITIONAL:
+                self.var_args = True
+                continue
+            if parameter.kind == parameter.VAR_KEYWORD:
+                self.var_kwargs = True
+                continue
+            if parameter.kind != parameter.KEYWORD_ONLY:
+                self.positional.append(parameter.name)
+            if parameter.kind != parameter.POSITIONAL_ONLY:
+                self.keywords.add(parameter.name)
+            if parameter.default is parameter.empty:
+                self.required.append((len(self.positional) - 1
+                                      if parameter.kind != parameter.KEYWORD_ONLY else None,
+                                      parameter.name))
+            if parameter.annotation in checked_types:
+                self.checks.append((len(self.positional) - 1
+                                    if parameter.kind != parameter.KEYWORD_ONLY else None,
+                                    parameter.name, parameter.annotation))
+        # Calls with only positional arguments, as many as this range allows,
+        # need no further checks.
+        self.fast_args = range(len(self.required),
+                               sys.maxsize if self.var_args else len(self.positional) + 1)
+        if self.checks or any(index == None for index, key in self.required):
+            self.fast_args = range(0)
+
+    def __call__(self, inp, capabilities, details=None, auth_start=None):
+        """Call the method for a caller with capabilities. details is only
+           needed for methods that request it. Returns a version 2 result.
+           Methods may change details["token"]. auth_start is when resolving
+           the caller began, so the time it took is recorded with the call."""
+        if self.metrics:
+            return self.timed_call(inp, capabilities, details, auth_start)
+        if self.limiter:
+            return self.limited_call(inp, capabilities, details)
+        if self.cache:
+            return self.cached_call(inp, capabilities, details)
+        return self.call(inp, capabilities, details)
+
+    def timed_call(self, inp, capabilities, details, auth_start):
+        start = time.perf_counter()
+        if self.limiter:
+            res = self.limited_call(inp, capabilities, details)
+        elif self.cache:
+            res = self.cached_call(inp, capabilities, details)
+        else:
+            res = self.call(inp, capabilities, details)
+        self.metrics.record_call(self.name, res, time.perf_counter() - start,
+                                 start - auth_start if auth_start is not None else None)
+        return res
+
+    def limited_call(self, inp, capabilities, details):
+        # Refuse unauthorized callers before they take from the limits.
+        if self.require is not None and self.require not in capabilities:
+            return error_result(not_authorized(self.name))
+        key = self.limiter.acquire(details)
+        if key is False:
+            return error_result(overloaded(self.name))
+        try:
+            if self.cache:
+                return self.cached_call(inp, capabilities, details)
+            return self.call(inp, capabilities, details)
+        finally:
+            self.limiter.release(key)
+
+    def cached_call(self, inp, capabilities, details):
+        if self.require is not None and self.require not in capabilities:
+            return error_result(not_authorized(self.name))
+        return self.cache.get_or_call(self.cache.key(inp, capabilities, details),
+                                      lambda: self.call(inp, capabilities, details))
+
+    def call(self, inp, capabilities, details):
+        try:
+            args = inp.get("args", [])
+            if not inp.get("kwargs") and type(args) is list and len(args) in self.fast_args:
+                if self.require is not None and self.require not in capabilities:
+                    raise not_authorized(self.name)
+                if self.details:
+                    call_result = self.method(*args, details=details)
+                else:
+                    call_result = self.method(*args)
+            else:
+                args, kwargs = self.bind(inp, capabilities, details)
+                call_result = self.method(*args, **kwargs)
+            if self.is_async:
+                call_result = asyncio.run(call_result)
+            if self.cache and isinstance(call_result, Iterator):
+                call_result = list(call_result)
+            return {"success":True,
+                    "result":call_result}
+        except SimpleWebAPIError as ex:
+            return error_result(ex)
+        except Exception:
+            traceback.print_exc()
+            return exception_result(self.name)
+
+    def bind(self, inp, capabilities, details):
+        """Check the caller and arguments of a call, returning args and kwargs."""
+        if self.require is not None and self.require not in capabilities:
+            raise not_authorized(self.name)
+        args = inp.get("args", [])
+        kwargs = inp.get("kwargs")
+        if kwargs == None:
+            kwargs = {}
+        if not isinstance(args, list) or not isinstance(kwargs, dict):
+            raise invalid_arguments(self.name, "takes a list of args and a dict of kwargs")
+        if len(args) > len(self.positional) and not self.var_args:
+            raise invalid_arguments(self.name, "takes at most " + str(len(self.positional)) + " positional arguments")
+        if not self.var_kwargs:
+            for key in kwargs:
+                if key not in self.keywords:
+                    raise invalid_arguments(self.name, "has no argument '" + str(key) + "'")
+        for index, key in self.required:
+            if (index == None or index >= len(args)) and key not in kwargs:
+                raise invalid_arguments(self.name, "is missing argument '" + key + "'")
+        for index, key, kind in self.checks:
+            if index != None and index < len(args):
+                args[index] = check_type(self.name, key, kind, args[index])
+            elif key in kwargs:
+                kwargs[key] = check_type(self.name, key, kind, kwargs[key])
+        if self.details:
+            kwargs["details"] = details
+        return args, kwargs
+
+def check_type(name, key, kind, value):
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise invalid_arguments(name, "needs " + kind.__name__ + " for argument '" + key + "'")
+    return value
+
+class Bundle:
+    """A generated client, precompressed and identified by a content hash."""
+    def __init__(self, source, content_type):
+        self.content_type = content_type
+        self.data = source.encode('UTF-8')
+        self.etag = hashlib.sha256(self.data).hexdigest()[:32]
+        self.gzip = gzip.compress(self.data, 9)
+        self.brotli = brotli.compress(self.data) if brotli else None
+
+    def variant(self, accept_encodings):
+        """Return the data, Content-Encoding and ETag to send."""
+        if self.brotli and accept_encodings["br"]:
+            return self.brotli, "br", self.etag + "-br"
+        if accept_encodings["gzip"]:
+            return self.gzip, "gzip", self.etag + "-gz"
+        return self.data, None, self.etag
+
 class SimpleWebAPI:
     def __init__(self):
-        self.api_methods = defaultdict(dict)
+        self.api_methods = {}
+        self.metrics = swa_metrics.Metrics()
+        self.metrics.describe("swa_calls_total", "counter", "API calls by method.")
+        self.metrics.describe("swa_errors_total", "counter", "Failed API calls by method and error name.")
+        self.metrics.describe("swa_handler_seconds", "histogram", "Time spent in API methods.")
+        self.metrics.describe("swa_auth_seconds_total", "counter", "Time spent resolving callers' sessions, by method.")
+        self.metrics.describe("swa_auth_total", "counter", "Calls whose caller's session was resolved, by method.")
+        self.metrics.describe("swa_serialize_seconds", "histogram", "Time spent encoding results.")
+        self.metrics.add_collector(self.collect_cache_metrics)
+        self.metrics.add_collector(self.collect_limit_metrics)
+        self._metrics_enabled = False
+        self.pending_options = defaultdict(dict)
         self.default_capability = None
         self.get_capabilities = lambda user: None
         self.check_token = lambda token: None
+        self.resolve_identity = None
         self.secure_cookies = False
         self.cookie_location = "/"
         self.cookie_name = "token"
         self.src_cache = {}
+        self.schema_data = None
+        self.bundle_max_age = 86400
+        self.max_batch_size = 100
+        self.async_threads = 20
+        self.executor = None
+        self.profiler = swa_profile.Profiler(self.api_methods)
+        self.profile_dir = None
 
         @Request.application
         def application(request):
-            if request.method == 'POST' and "application/json" in request.content_type.lower():
-                inp = json.loads(request.data.decode('UTF-8'))
-                api_version = inp.get("version", 1)
-                try:
-                    method = inp['method']
-                    conf = self.api_methods[method]
-                    kwargs = inp.get("kwargs", {});
-                    token = None 
-                    if "token" in inp:
-                        token = inp["token"]
-                    elif self.cookie_name in request.cookies:
-                        token = request.cookies[self.cookie_name]
-                    user = self.check_token(token)
-                    capabilities = self.get_capabilities(user)
-                    if not capabilities:
-                        capabilities = set()
-                    details = {
-                            "ip":request.remote_addr,
-                            "user":user,
-                            "capabilities":capabilities,
-                            "token":token,
-                            "request":request
-                            }
-                    if conf["details"]:
-                        kwargs["details"] = details
-                    require = conf["require"]
-                    if require == None or require in capabilities:
-                        try:
-                            call_result = conf["method"](*inp.get("args", []), **kwargs)
-                            res = {"success":True,     
-                                   "result":call_result}
-                        except SimpleWebAPIError as ex:
-                            res = {"success":False,
-                                   "error":ex.error_name,
-                                   "error_message":ex.message}
-                        if details["token"] != token:
-                            token = details["token"]
-                    else:
-                        res = {"success":False,
-                               "error":"NotAuthorized",
-                               "error_message":"The current user cannot call method '" + method + "'."}
-                except Exception as ex:
-                    traceback.print_exc()
-                    res = {"success":False,
-                           "error":"Exception",
-                           "error_message":"An exception occured while calling method '" + method + "'."}
-                if api_version < 2:
-                    if res["success"]:
-                        res = res["result"]
-                    else:
-                        res = {"SimpleWebAPIError":res["error"],
-                               "Message":res["error_message"]}
-                response_object = Response(json.dumps(res))
-                if token:
-                    response_object.set_cookie(self.cookie_name, token, expires=datetime.datetime.fromtimestamp(time.time()+31557600),httponly=True,secure=self.secure_cookies, path=self.cookie_location)
-                return response_object
-            elif request.path.endswith("/.js"):
-                if "js" not in self.src_cache:
-                    self.src_cache["js"] = swa_gen_js.gen_api(self.api_methods, request.url.replace(".js", ""))
-                return Response(self.src_cache["js"])
-            elif request.path.endswith("/.py"):
-                if "py" not in self.src_cache:
-                    self.src_cache["py"] = swa_gen_py.gen_api(self.api_methods, request.url.replace(".py", ""))
-                return Response(self.src_cache["py"])
-            else:
-                return Response(json.dumps(list(self.api_methods.keys())))
-        
+            codec = self.request_codec(request)
+            if codec:
+                inp = codec.loads(request.get_data())
+                if isinstance(inp, list):
+                    res, token = self.call_batch(inp, request)
+                else:
+                    res, token = self.call(inp, request)
+                return self.call_response(inp, res, token, self.response_codec(request, codec),
+                                          self.accepts_stream(request))
+            inp = self.get_call_input(request)
+            if inp != None:
+                res = self.get_call_error(inp)
+                token = self.get_token(inp, request)
+                if res == None:
+                    res, token = self.call(inp, request)
+                return self.get_call_response(request, inp, res, token)
+            return self.resource_response(request)
+
         self.application = application
 
-        @self.add()
+        async def asgi_application(scope, receive, send):
+            """ASGI entry point, serving the same API as application."""
+            if scope["type"] == "lifespan":
+                while True:
+                    message = await receive()
+                    if message["type"] == "lifespan.startup":
+                        await send({"type":"lifespan.startup.complete"})
+                    elif message["type"] == "lifespan.shutdown":
+                        if self.executor:
+                            self.executor.shutdown(wait=False)
+                        await send({"type":"lifespan.shutdown.complete"})
+                        return
+            if scope["type"] != "http":
+                return
+            body = []
+            while True:
+                message = await receive()
+                body.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body = b"".join(body)
+            request = Request(asgi_environ(scope, body))
+            codec = self.request_codec(request)
+            if codec:
+                inp = codec.loads(body)
+                if isinstance(inp, list):
+                    res, token = await self.call_batch_async(inp, request)
+                else:
+                    res, token = await self.call_async(inp, request)
+                stream = self.accepts_stream(request)
+                res = await self.collect_async(inp, res, stream)
+                response = self.call_response(inp, res, token, self.response_codec(request, codec), stream)
+            else:
+                inp = self.get_call_input(request)
+                if inp != None:
+                    res = self.get_call_error(inp)
+                    token = self.get_token(inp, request)
+                    if res == None:
+                        res, token = await self.call_async(inp, request)
+                        res = await self.collect_async(inp, res)
+                    response = self.get_call_response(request, inp, res, token)
+                else:
+                    response = self.resource_response(request)
+            await send({"type":"http.response.start",
+                        "status":response.status_code,
+                        "headers":[(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for key, value in response.headers.items()]})
+            if response.is_streamed:
+                # Streamed results may query the database, so produce them on the thread pool.
+                chunks = iter(response.response)
+                while True:
+                    chunk = await self.run_sync(next, chunks, None)
+                    if chunk == None:
+                        break
+                    await send({"type":"http.response.body", "body":chunk, "more_body":True})
+                await send({"type":"http.response.body", "body":b""})
+            else:
+                await send({"type":"http.response.body",
+                            "body":response.get_data()})
+
+        self.asgi_application = asgi_application
+
+        @self.add(idempotent=True)
         def getMethods():
             return list(self.api_methods.keys())
 
@@ -109,16 +482,415 @@ class SimpleWebAPI:
         def hasCapability(capability, details):
             return capability in details['capabilities']
 
+        @self.add(require="profiler")
+        def startProfile(method=None, calls=100, sample=1.0):
+            if method == None:
+                names = [name for name in self.api_methods if name not in profiler_methods]
+            elif method in self.api_methods and method not in profiler_methods:
+                names = [method]
+            else:
+                raise SimpleWebAPIError("UnknownMethod", "There is no method '" + str(method) + "'.")
+            self.profiler.start(names, calls, sample, self.profile_dir)
+
+        @self.add(require="profiler")
+        def stopProfile():
+            self.profiler.stop()
+
+        @self.add(require="profiler")
+        def getProfile(sort="cumulative", limit=50):
+            if sort not in swa_profile.sort_keys:
+                raise invalid_arguments("getProfile", "cannot sort by '" + str(sort) + "'")
+            return self.profiler.report(sort, limit)
+
+    def request_codec(self, request):
+        """Return the codec for an API call, or None if request is not a call."""
+        if request.method != 'POST':
+            return None
+        return swa_codecs.get_codec(request.content_type)
+
+    def response_codec(self, request, codec):
+        """Return the codec named in the Accept header, defaulting to codec."""
+        for content_type, quality in request.accept_mimetypes:
+            if content_type in swa_codecs.codecs:
+                return swa_codecs.codecs[content_type]
+        return codec
+
+    def accepts_stream(self, request):
+        """Whether the caller asked for streamed results. Only an explicit
+           Accept entry counts, not a wildcard."""
+        return any(content_type == stream_content_type for content_type, quality in request.accept_mimetypes)
+
+    def call_response(self, inp, res, token, codec, stream=False):
+        if isinstance(res, list):
+            res = [collect_result(call.get("method") if isinstance(call, dict) else None, call_res)
+                   for call, call_res in zip(inp, res)]
+        elif res["success"] and isinstance(res["result"], Iterator):
+            if stream and inp.get("version", 1) >= 2:
+                response_object = Response(stream_lines(inp.get("method"), res["result"],
+                                                        swa_codecs.codecs["application/json"].dumps),
+                                           content_type=stream_content_type)
+                return self.finish_call_response(response_object, token)
+            res = collect_result(inp.get("method"), res)
+        if isinstance(inp, dict) and inp.get("version", 1) < 2:
+            if res["success"]:
+                res = res["result"]
+            else:
+                res = {"SimpleWebAPIError":res["error"],
+                       "Message":res["error_message"]}
+        data = self.encode(codec, res)
+        response_object = Response(data, content_type=codec.content_type)
+        return self.finish_call_response(response_object, token)
+
+    def encode(self, codec, res):
+        """Encode a result, timing it if metrics are enabled."""
+        if not self.metrics_enabled:
+            return codec.dumps(res)
+        start = time.perf_counter()
+        data = codec.dumps(res)
+        self.metrics.observe("swa_serialize_seconds", (("codec", codec.name),), time.perf_counter() - start)
+        return data
+
+    def get_call_input(self, request):
+        """Return the call made by a GET request, or None if it is not one.
+           Arguments are JSON in the args and kwargs query parameters."""
+        if request.method not in ("GET", "HEAD") or "method" not in request.args:
+            return None
+        inp = {"method":request.args["method"], "version":2}
+        try:
+            inp["args"] = json.loads(request.args.get("args", "[]"))
+            inp["kwargs"] = json.loads(request.args.get("kwargs", "{}"))
+        except ValueError:
+            inp["args"] = inp["kwargs"] = None
+        return inp
+
+    def get_call_error(self, inp):
+        """Return the error result for a GET call that cannot be made, or None."""
+        name = inp["method"]
+        invoker = self.api_methods.get(name)
+        if not invoker:
+            return unknown_method_result(name)
+        if not invoker.idempotent:
+            return error_result(get_not_allowed(name))
+        if type(inp["args"]) is not list or type(inp["kwargs"]) is not dict:
+            return error_result(invalid_arguments(name, "takes args as a JSON array and kwargs as a JSON object"))
+        return None
+
+    def get_call_response(self, request, inp, res, token):
+        """Respond to a GET call with validators and the method's Cache-Control
+           policy. Results that depend on the caller are private."""
+        name = inp["method"]
+        res = collect_result(name, res)
+        codec = self.response_codec(request, swa_codecs.codecs["application/json"])
+        data = self.encode(codec, res)
+        response_object = Response(data, content_type=codec.content_type)
+        if res["success"]:
+            invoker = self.api_methods[name]
+            etag = hashlib.sha256(data).hexdigest()[:32]
+            response_object.set_etag(etag)
+            policy = "private" if invoker.needs_auth else "public"
+            if invoker.max_age:
+                response_object.headers["Cache-Control"] = policy + ", max-age=" + str(invoker.max_age)
+            else:
+                response_object.headers["Cache-Control"] = policy + ", no-cache"
+            response_object.headers["Vary"] = "Accept, Cookie" if invoker.needs_auth else "Accept"
+            response_object.make_conditional(request)
+        else:
+            response_object.headers["Cache-Control"] = "no-store"
+        # Only a changed session is sent back, so shared caches can keep public results.
+        if token == request.cookies.get(self.cookie_name):
+            token = None
+        return self.finish_call_response(response_object, token)
+
+    def finish_call_response(self, response_object, token):
+        """Add the schema hash and the session cookie to a call's response."""
+        response_object.headers["X-SWA-Schema"] = self.schema()["hash"]
+        if token:
+            response_object.set_cookie(self.cookie_name, token, expires=datetime.datetime.fromtimestamp(time.time()+31557600),httponly=True,secure=self.secure_cookies, path=self.cookie_location)
+        return response_object
+
+    def bundle_response(self, request, kind):
+        """Serve a generated client or the schema, compressed and cacheable."""
+        url = request.base_url[:-len(kind)-1]
+        bundle = self.src_cache.get((kind, url))
+        if not bundle:
+            if kind == "js":
+                bundle = Bundle(swa_gen_js.gen_api(self.api_methods, url), "application/javascript")
+            elif kind == "schema":
+                bundle = Bundle(json.dumps(self.schema()), "application/json")
+            else:
+                bundle = Bundle(swa_gen_py.gen_api(self.api_methods, url), "text/x-python")
+            # Each Host header gets its own bundle, so keep the cache bounded.
+            if len(self.src_cache) >= 16:
+                self.src_cache.clear()
+            self.src_cache[(kind, url)] = bundle
+        data, encoding, etag = bundle.variant(request.accept_encodings)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(data, content_type=bundle.content_type)
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        if kind == "schema":
+            # Clients fetch the schema when its hash changes, so it must not be stale.
+            response.headers["Cache-Control"] = "no-cache"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=" + str(self.bundle_max_age)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    def resource_response(self, request):
+        if request.path.endswith("/.js"):
+            return self.bundle_response(request, "js")
+        elif request.path.endswith("/.py"):
+            return self.bundle_response(request, "py")
+        elif request.path.endswith("/.schema"):
+            return self.bundle_response(request, "schema")
+        elif request.path.endswith("/.metrics") and self.metrics_enabled:
+            return Response(self.metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+        else:
+            return Response(json.dumps(list(self.api_methods.keys())))
+
+    def get_token(self, inp, request):
+        if "token" in inp:
+            return inp["token"]
+        return request.cookies.get(self.cookie_name)
+
+    def get_caller_capabilities(self, token):
+        if self.resolve_identity:
+            identity = self.resolve_identity(token)
+            capabilities = identity["capabilities"] if identity else None
+        else:
+            capabilities = self.get_capabilities(self.check_token(token))
+        return capabilities or no_capabilities
+
+    def authenticate(self, token, request):
+        """Resolve a token into the details passed to API methods."""
+        user_id = role = None
+        if self.resolve_identity:
+            identity = self.resolve_identity(token)
+            if identity:
+                user = identity["user"]
+                user_id = identity.get("user_id")
+                role = identity.get("role")
+                capabilities = identity["capabilities"]
+            else:
+                user = capabilities = None
+        else:
+            user = self.check_token(token)
+            capabilities = self.get_capabilities(user)
+        if not capabilities:
+            capabilities = set()
+        return {
+                "ip":request.remote_addr,
+                "user":user,
+                "user_id":user_id,
+                "role":role,
+                "capabilities":capabilities,
+                "token":token,
+                "request":request
+                }
+
+    async def invoke_async(self, invoker, inp, capabilities, details=None, auth_start=None):
+        """Call a method like MethodInvoker, awaiting coroutine methods
+           and running others on the thread pool."""
+        if not invoker.is_async:
+            return await self.run_sync(invoker, inp, capabilities, details, auth_start)
+        metrics = invoker.metrics
+        if metrics:
+            start = time.perf_counter()
+            auth = start - auth_start if auth_start is not None else None
+        cache = invoker.cache
+        res = None
+        limit_key = None
+        if invoker.limiter:
+            if invoker.require is not None and invoker.require not in capabilities:
+                res = error_result(not_authorized(invoker.name))
+            else:
+                limit_key = invoker.limiter.acquire(details)
+                if limit_key is False:
+                    res = error_result(overloaded(invoker.name))
+        if res:
+            if metrics:
+                metrics.record_call(invoker.name, res, time.perf_counter() - start, auth)
+            return res
+        try:
+            args, kwargs = invoker.bind(inp, capabilities, details)
+            if cache:
+                key = cache.key(inp, capabilities, details)
+                generation = cache.generation
+                res = cache.get(key)
+            if not res:
+                res = {"success":True,
+                       "result":await invoker.method(*args, **kwargs)}
+                if cache:
+                    cache.put(key, res, generation)
+        except SimpleWebAPIError as ex:
+            res = error_result(ex)
+        except Exception:
+            traceback.print_exc()
+            res = exception_result(invoker.name)
+        finally:
+            if invoker.limiter:
+                invoker.limiter.release(limit_key)
+        if metrics:
+            metrics.record_call(invoker.name, res, time.perf_counter() - start, auth)
+        return res
+
+    def call(self, inp, request):
+        """Handle a single call. Returns a version 2 result and the new token."""
+        token = inp["token"] if "token" in inp else request.cookies.get(self.cookie_name)
+        invoker = self.api_methods.get(inp.get("method"))
+        if not invoker:
+            return unknown_method_result(inp.get("method")), token
+        if not invoker.needs_auth:
+            return invoker(inp, no_capabilities), token
+        auth_start = time.perf_counter() if invoker.metrics else None
+        try:
+            if not invoker.needs_details:
+                return invoker(inp, self.get_caller_capabilities(token), None, auth_start), token
+            details = self.authenticate(token, request)
+        except Exception:
+            traceback.print_exc()
+            return exception_result(invoker.name), token
+        res = invoker(inp, details["capabilities"], details, auth_start)
+        return res, details["token"]
+
+    def call_batch(self, calls, request):
+        """Handle a batch of calls, resolving the caller at most once. Calls run
+           in order and see token changes made by earlier calls.
+           Returns a list of version 2 results and the new token."""
+        if len(calls) > self.max_batch_size:
+            return batch_too_large_result(self.max_batch_size), None
+        token = self.get_token(calls[0] if calls and isinstance(calls[0], dict) else {}, request)
+        results = []
+        details = None
+        for inp in calls:
+            if not isinstance(inp, dict):
+                results.append(invalid_call_result())
+                continue
+            invoker = self.api_methods.get(inp.get("method"))
+            if not invoker:
+                results.append(unknown_method_result(inp.get("method")))
+                continue
+            if not invoker.needs_auth:
+                results.append(invoker(inp, no_capabilities))
+                continue
+            auth_start = None
+            if details == None:
+                auth_start = time.perf_counter() if invoker.metrics else None
+                try:
+                    details = self.authenticate(token, request)
+                except Exception:
+                    traceback.print_exc()
+                    results.append(exception_result(invoker.name))
+                    continue
+            call_details = dict(details)
+            results.append(invoker(inp, call_details["capabilities"], call_details, auth_start))
+            if call_details["token"] != token:
+                token = call_details["token"]
+                details = None
+        return results, token
+
+    async def run_sync(self, function, *args):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(self.async_threads, thread_name_prefix="swa-asgi")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def collect_async(self, inp, res, stream=False):
+        """Collect iterator results that will not be streamed on the thread
+           pool, as generators may block while producing items."""
+        if isinstance(res, list):
+            return [await self.collect_async(call, call_res) for call, call_res in zip(inp, res)]
+        if not res["success"] or not isinstance(res["result"], Iterator):
+            return res
+        if stream and inp.get("version", 1) >= 2:
+            return res
+        return await self.run_sync(collect_result, inp.get("method"), res)
+
+    async def call_async(self, inp, request):
+        token = self.get_token(inp, request)
+        invoker = self.api_methods.get(inp.get("method"))
+        if not invoker:
+            return unknown_method_result(inp.get("method")), token
+        if not invoker.needs_auth:
+            return await self.invoke_async(invoker, inp, no_capabilities), token
+        auth_start = time.perf_counter() if invoker.metrics else None
+        try:
+            details = await self.run_sync(self.authenticate, token, request)
+        except Exception:
+            traceback.print_exc()
+            return exception_result(invoker.name), token
+        res = await self.invoke_async(invoker, inp, details["capabilities"], details, auth_start)
+        return res, details["token"]
+
+    async def call_batch_async(self, calls, request):
+        if len(calls) > self.max_batch_size:
+            return batch_too_large_result(self.max_batch_size), None
+        token = self.get_token(calls[0] if calls and isinstance(calls[0], dict) else {}, request)
+        results = []
+        details = None
+        for inp in calls:
+            if not isinstance(inp, dict):
+                results.append(invalid_call_result())
+                continue
+            invoker = self.api_methods.get(inp.get("method"))
+            if not invoker:
+                results.append(unknown_method_result(inp.get("method")))
+                continue
+            if not invoker.needs_auth:
+                results.append(await self.invoke_async(invoker, inp, no_capabilities))
+                continue
+            auth_start = None
+            if details == None:
+                auth_start = time.perf_counter() if invoker.metrics else None
+                try:
+                    details = await self.run_sync(self.authenticate, token, request)
+                except Exception:
+                    traceback.print_exc()
+                    results.append(exception_result(invoker.name))
+                    continue
+            call_details = dict(details)
+            results.append(await self.invoke_async(invoker, inp, call_details["capabilities"], call_details,
+                                                   auth_start))
+            if call_details["token"] != token:
+                token = call_details["token"]
+                details = None
+        return results, token
+
     def details(self, function):
         """Deprecated decorator to request details."""
-        self.api_methods[function.__name__]["details"] = True
+        self.set_option(function.__name__, "details", True)
         return function
 
-    def add(self, require="DEFAULT_CAP", details=False, name=None):
+    def set_option(self, name, option, value):
+        invoker = self.api_methods.get(name)
+        if invoker:
+            options = {"require":invoker.require, "details":invoker.details,
+                       "metrics":invoker.metrics, "cache":invoker.cache, "limiter":invoker.limiter,
+                       "idempotent":invoker.idempotent, "max_age":invoker.max_age}
+            options[option] = value
+            self.src_cache.clear()
+            self.schema_data = None
+            self.api_methods[name] = MethodInvoker(name, invoker.method, **options)
+        else:
+            self.pending_options[name][option] = value
+
+    def add(self, require="DEFAULT_CAP", details=False, name=None, cache=None,
+            max_concurrency=None, rate=None, limit_by=None, idempotent=False, max_age=0):
         """Add a function to the api. (Decorator)
            require: Require a capability to call the function.
            details: Request details of API call, such as user.
-           name: Use a different name for the function."""
+           name: Use a different name for the function.
+           cache: Keep results for a number of seconds, or a dict of
+                  swa_cache.ResultCache arguments (ttl, size, vary).
+           max_concurrency: Refuse calls while this many are running.
+           rate: Refuse calls beyond this many per second, or a dict
+                 with rate and burst.
+           limit_by: Apply the limits to each "user" or "ip" separately.
+           Refused calls fail straight away with the Overloaded error.
+           idempotent: Allow calls with GET, which browsers and proxies may cache.
+           max_age: Seconds a GET result may be reused without checking its ETag."""
         # The API used to use this as a "plain" decorator that
         # added the function to the API without any settings.
         if hasattr(require, "__call__"):
@@ -126,22 +898,62 @@ class SimpleWebAPI:
 
         def add_decorator(function):
             function_name = name or function.__name__
-            conf = self.api_methods[function_name]
-            conf["method"] = function
-            if not "require" in conf:
-                if require != "DEFAULT_CAP":
-                    conf["require"] = require
-                else:
-                    conf["require"] = self.default_capability
-            if not "details" in conf:
-                conf["details"] = details
+            self.src_cache.clear()
+            self.schema_data = None
+            options = {"require":self.default_capability if require == "DEFAULT_CAP" else require,
+                       "details":details,
+                       "metrics":self.metrics if self.metrics_enabled else None,
+                       "cache":cache,
+                       "limiter":swa_limits.make_limiter(max_concurrency, rate, limit_by),
+                       "idempotent":idempotent,
+                       "max_age":max_age}
+            options.update(self.pending_options.pop(function_name, {}))
+            self.api_methods[function_name] = MethodInvoker(function_name, function, **options)
             return function
         return add_decorator
 
+    def invalidate(self, name, *args, **kwargs):
+        """Drop cached results of a method for a call with args and kwargs,
+           or all of them if none are given. Arguments must be passed the
+           same way, positionally or by keyword, as in the cached calls."""
+        cache = self.api_methods[name].cache
+        if cache:
+            if args or kwargs:
+                cache.invalidate(list(args), kwargs)
+            else:
+                cache.invalidate()
+
+    def collect_limit_metrics(self):
+        stats = [(invoker.labels, invoker.limiter.stats())
+                 for invoker in list(self.api_methods.values()) if invoker.limiter]
+        return [("swa_limited_calls_active", "gauge", "Calls running in methods with limits.",
+                 [(labels, limits["active"]) for labels, limits in stats])]
+
+    def collect_cache_metrics(self):
+        stats = [(invoker.labels, invoker.cache.stats())
+                 for invoker in list(self.api_methods.values()) if invoker.cache]
+        return [("swa_cache_hits_total", "counter", "Results served from method caches.",
+                 [(labels, cache["hits"]) for labels, cache in stats]),
+                ("swa_cache_misses_total", "counter", "Calls that missed method caches.",
+                 [(labels, cache["misses"]) for labels, cache in stats]),
+                ("swa_cache_entries", "gauge", "Results in method caches.",
+                 [(labels, cache["entries"]) for labels, cache in stats])]
+
+    def schema(self):
+        """Describe every method, with a hash that changes whenever they do."""
+        schema = self.schema_data
+        if schema == None:
+            # Hash the methods as clients will load them from JSON, where
+            # dict keys are strings and can be sorted.
+            methods = json.loads(json.dumps({name:method_schema(invoker) for name, invoker in self.api_methods.items()}))
+            digest = hashlib.sha256(json.dumps(methods, sort_keys=True).encode('UTF-8')).hexdigest()[:32]
+            schema = self.schema_data = {"version":schema_version, "hash":digest, "methods":methods}
+        return schema
+
     def capability(self, require):
         """Deprecated decorator to set capability."""
         def capability_decorator(function):
-            self.api_methods[function.__name__]["require"] = require
+            self.set_option(function.__name__, "require", require)
             return function
         return capability_decorator
 
@@ -152,6 +964,27 @@ class SimpleWebAPI:
     def set_token_lookup_handler(self, function):
         self.check_token = function
         return function
+
+    def set_identity_handler(self, function):
+        """Set a handler resolving a token to a dict with user, user_id, role
+           and capabilities in one step. Used instead of the token lookup
+           and capability handlers when set."""
+        self.resolve_identity = function
+        return function
+    @property
+    def metrics_enabled(self):
+        """Whether calls are timed and recorded, and /.metrics is served.
+           Invokers are only given the metrics while this is set, so calls
+           are not timed otherwise."""
+        return self._metrics_enabled
+
+    @metrics_enabled.setter
+    def metrics_enabled(self, value):
+        self._metrics_enabled = value
+        for invoker in self.api_methods.values():
+            # Profiled methods are wrapped, so set the metrics of the invoker itself.
+            getattr(invoker, "invoker", invoker).metrics = self.metrics if value else None
+
     def upd_settings(self, settings):
         for key, value in settings.items():
             setattr(self, key, value) 
@@ -160,22 +993,35 @@ class ClassAPI:
     def __init__(self):
         self.api_methods = defaultdict(dict)
 
-    def add(self, require="DEFAULT_CAP", details=False, name=None):
+    def add(self, require="DEFAULT_CAP", details=False, name=None, cache=None,
+            max_concurrency=None, rate=None, limit_by=None, idempotent=False, max_age=0):
         """Stage a method to be added to the API. (Decorator)
            require: Require a capability to call the function.
            details: Request details of API call, such as user.
-           name: Use a different name for the function."""
+           name: Use a different name for the function.
+           cache: Keep results, as for SimpleWebAPI.add.
+           max_concurrency, rate, limit_by: Limits, as for SimpleWebAPI.add.
+           idempotent, max_age: GET calls, as for SimpleWebAPI.add."""
 
         def add_decorator(function):
             function_name = name or function.__name__
             self.api_methods[function_name] = {"method": function,
                     "require": require,
-                    "details": details}
+                    "details": details,
+                    "cache": cache,
+                    "max_concurrency": max_concurrency,
+                    "rate": rate,
+                    "limit_by": limit_by,
+                    "idempotent": idempotent,
+                    "max_age": max_age}
             return function
         return add_decorator
 
     def commit(self, obj, api):
         for name, conf in self.api_methods.items():
             method = conf["method"].__get__(obj, obj.__class__)
-            api.add(require=conf["require"], details=conf["details"], name=name)(method)
+            api.add(require=conf["require"], details=conf["details"], name=name,
+                    cache=conf["cache"], max_concurrency=conf["max_concurrency"],
+                    rate=conf["rate"], limit_by=conf["limit_by"],
+                    idempotent=conf["idempotent"], max_age=conf["max_age"])(method)
 
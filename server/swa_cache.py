@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+class Flight:
+    """A call whose result other callers of the same key are waiting for."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class ResultCache:
+    """Bounded LRU cache of the results of one API method.
+       ttl: Seconds a result is kept.
+       size: Maximum number of results kept.
+       vary: None to share results between all callers, "user" to keep
+           them per user or "capabilities" to keep them per capability set.
+       Only successful results are kept. Concurrent misses for the same
+       key wait for one call instead of each calling the method."""
+    def __init__(self, ttl=60, size=1000, vary=None):
+        if vary not in (None, "user", "capabilities"):
+            raise ValueError("vary must be None, 'user' or 'capabilities'.")
+        self.ttl = ttl
+        self.size = size
+        self.vary = vary
+        self.entries = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        # Incremented by invalidate, so results computed before it are not stored.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def args_key(self, args, kwargs):
+        return json.dumps([args or [], kwargs or {}], sort_keys=True, default=repr)
+
+    def key(self, inp, capabilities, details):
+        args = self.args_key(inp.get("args"), inp.get("kwargs"))
+        if self.vary == "user":
+            return (args, details["user"])
+        if self.vary == "capabilities":
+            return (args, frozenset(capabilities))
+        return (args, None)
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, result, generation):
+        """Store a result computed when the cache was at generation."""
+        if not result["success"] or self.size <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get_or_call(self, key, function):
+        """Return the cached result for key, or call function to get it."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            flight = self.flights.get(key)
+            leader = flight == None
+            if leader:
+                flight = self.flights[key] = Flight()
+            generation = self.generation
+        if not leader:
+            flight.event.wait()
+            return flight.result
+        try:
+            flight.result = function()
+            self.put(key, flight.result, generation)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+    def invalidate(self, args=None, kwargs=None):
+        """Drop the results for a call with args and kwargs, for every
+           user, or all results if neither is given."""
+        with self.lock:
+            self.generation += 1
+            if args == None and kwargs == None:
+                self.entries.clear()
+                return
+            args = self.args_key(args, kwargs)
+            for key in [key for key in self.entries if key[0] == args]:
+                del self.entries[key]
+
+    def stats(self):
+        return {"hits":self.hits,
+                "misses":self.misses,
+                "entries":len(self.entries)}
+
+def make_cache(option):
+    """Make the cache for a method's cache option: None, a ResultCache,
+       a dict of ResultCache arguments or a TTL in seconds."""
+    if option == None or option is False or isinstance(option, ResultCache):
+        return option or None
+    if isinstance(option, dict):
+        return ResultCache(**option)
+    return ResultCache(ttl=option)
@@ -0,0 +1,66 @@
+import json
+
+class Codec:
+    """Encodes and decodes API calls and results for one content type.
+       dumps: Convert a value to bytes.
+       loads: Convert bytes to a value."""
+    def __init__(self, name, content_type, dumps, loads):
+        self.name = name
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+
+codecs = {}
+
+def register_codec(codec, *aliases):
+    """Make codec available for its content type and any aliases."""
+    for content_type in (codec.content_type,) + aliases:
+        codecs[content_type] = codec
+
+def get_codec(content_type):
+    """Return the codec for a Content-Type header, or None."""
+    if not content_type:
+        return None
+    return codecs.get(content_type.split(";")[0].strip().lower())
+
+def json_dumps(value):
+    return json.dumps(value).encode('UTF-8')
+
+def json_loads(data):
+    return json.loads(data.decode('UTF-8'))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    def orjson_dumps(value):
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Values orjson rejects, such as integers over 64 bits.
+            return json_dumps(value)
+
+    register_codec(Codec("json", "application/json", orjson_dumps, orjson.loads))
+else:
+    register_codec(Codec("json", "application/json", json_dumps, json_loads))
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if msgpack:
+    register_codec(Codec("msgpack", "application/msgpack",
+                         lambda value: msgpack.packb(value, use_bin_type=True),
+                         lambda data: msgpack.unpackb(data, raw=False)),
+                   "application/x-msgpack")
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+if cbor2:
+    register_codec(Codec("cbor", "application/cbor", cbor2.dumps, cbor2.loads))
@@ -1,7 +1,7 @@
-from inspect import signature
+from inspect import signature, isgeneratorfunction
 import json
 
-def gen_function(func, name, ignore_details, legacy=False):
+def gen_function(func, name, ignore_details, legacy=False, idempotent=False):
     args = []
     call = []
     kw = ""
@@ -22,12 +22,16 @@ def gen_function(func, name, ignore_details, legacy=False):
         else:
             args.append(argument.name)
             call.append(argument.name)
-    if call:
+    if call or kw or idempotent:
         rest += ", [" + ", ".join(call) + "]"
-    if kw:
-        rest += kw
+    if kw or idempotent:
+        rest += kw or ", {}"
     args = ", ".join(args)
-    return "export function "+name+"("+args+") { return jsonRequest('"+name+"'"+rest+"); }"
+    function = ("export function "+name+"("+args+") { return jsonRequest('"+name+"'"+rest
+                +(", true" if idempotent else "")+"); }")
+    if isgeneratorfunction(func):
+        function += "\nexport function "+name+"Stream("+args+") { return callStream('"+name+"'"+rest+"); }"
+    return function
 
 
 js_lib = """/* 
@@ -35,19 +39,121 @@ js_lib = """/*
  */
 
 const url = "{{url}}";
-const jsonCT = new Headers();
-jsonCT.append('Content-Type', 'application/json');
+// Seconds each method's results may be reused, from its max_age on the server.
+const cacheTTL = {{cache_ttl}};
+let cacheSize = 500;
+const cache = new Map();
+const inflight = new Map();
+// Incremented by invalidate, so results requested before it are not kept.
+let generation = 0;
+let codec = {
+    contentType: 'application/json',
+    encode: value => JSON.stringify(value),
+    decode: buffer => JSON.parse(new TextDecoder().decode(buffer))
+};
 
-function jsonRequest(method, args=[], kwargs={}) {
+/*
+ * Use a different wire encoding. codec is {contentType, encode, decode}, where
+ * encode returns a request body and decode takes an ArrayBuffer. For example,
+ * with @msgpack/msgpack: setCodec({contentType: 'application/msgpack', encode, decode}).
+ */
+export function setCodec(newCodec) {
+    codec = newCodec;
+}
+
+function post(body) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {'Content-Type': codec.contentType, 'Accept': codec.contentType},
+        credentials: 'include',
+        body: codec.encode(body)
+    });
+}
+
+/*
+ * Call an idempotent method with GET, so the browser and proxies can cache
+ * the result. The session is sent in its cookie.
+ */
+function get(method, args, kwargs) {
+    let query = '?method=' + encodeURIComponent(method);
+    if (args.length) query += '&args=' + encodeURIComponent(JSON.stringify(args));
+    if (Object.keys(kwargs).length) query += '&kwargs=' + encodeURIComponent(JSON.stringify(kwargs));
+    return fetch(url + query, {
+        method: 'GET',
+        headers: {'Accept': codec.contentType},
+        credentials: 'include'
+    });
+}
+
+/*
+ * Keep at most size results of idempotent methods. 0 turns the cache off.
+ */
+export function setCacheSize(size) {
+    cacheSize = size;
+    while (cache.size > cacheSize) cache.delete(cache.keys().next().value);
+}
+
+function callKey(method, args, kwargs) {
+    return method + '\\n' + JSON.stringify([args, kwargs]);
+}
+
+/*
+ * Drop kept results for a call to method with args and kwargs, all results of
+ * method if args is not given, or every result if method is not given. Calls
+ * made after this do not share requests that were already in flight.
+ */
+export function invalidate(method, args, kwargs={}) {
+    generation++;
+    for (const entries of [cache, inflight]) {
+        if (method === undefined) {
+            entries.clear();
+        } else if (args === undefined) {
+            for (const key of [...entries.keys()]) {
+                if (key.startsWith(method + '\\n')) entries.delete(key);
+            }
+        } else {
+            entries.delete(callKey(method, args, kwargs));
+        }
+    }
+}
+
+/*
+ * Calls to idempotent methods with the same arguments share one request while
+ * it is in flight, and their results are kept for the method's TTL. Shared
+ * results are the same object for every caller, so do not modify them.
+ */
+function jsonRequest(method, args=[], kwargs={}, idempotent=false) {
+    if (!idempotent) return sendRequest(method, args, kwargs, false);
+    const key = callKey(method, args, kwargs);
+    const entry = cache.get(key);
+    if (entry) {
+        cache.delete(key);
+        if (entry.expires > Date.now()) {
+            cache.set(key, entry);
+            return Promise.resolve(entry.value);
+        }
+    }
+    if (inflight.has(key)) return inflight.get(key);
+    const started = generation;
+    const promise = sendRequest(method, args, kwargs, true).then(value => {
+        const ttl = cacheTTL[method];
+        if (ttl && cacheSize > 0 && started == generation) {
+            cache.set(key, {expires: Date.now() + ttl * 1000, value});
+            while (cache.size > cacheSize) cache.delete(cache.keys().next().value);
+        }
+        return value;
+    }).finally(() => {
+        if (inflight.get(key) === promise) inflight.delete(key);
+    });
+    inflight.set(key, promise);
+    return promise;
+}
+
+function sendRequest(method, args, kwargs, idempotent) {
     return new Promise((resolve, reject) => {
-        fetch(url, {
-            method: 'POST',
-            headers: jsonCT,
-            credentials: 'include',
-            body: JSON.stringify({method,args,kwargs,"version":2})
-        }).then(response => {
+        (idempotent ? get(method, args, kwargs) : post({method,args,kwargs,"version":2})).then(response => {
             if (response.status == 200) {
-                response.json().then(res => {
+                response.arrayBuffer().then(codec.decode).then(res => {
                     if (!res.success) {
                         console.log(res.error + ": " + res.error_message);
                         reject(res.error);
@@ -56,19 +162,88 @@ function jsonRequest(method, args=[], kwargs={}) {
                     }
                 });
             } else {
-                reject(status);
+                reject(response.status);
             }                
         }).catch(error => reject(error));
     });
 }
 
+/*
+ * Call several methods in one request. Each call is [method, args, kwargs].
+ * Resolves to an array of {success, result} or {success, error, error_message}.
+ */
+export function callBatch(calls) {
+    return new Promise((resolve, reject) => {
+        post(calls.map(([method, args=[], kwargs={}]) => ({method,args,kwargs,"version":2}))).then(response => {
+            if (response.status == 200) {
+                response.arrayBuffer().then(codec.decode).then(res => {
+                    if (!Array.isArray(res)) {
+                        console.log(res.error + ": " + res.error_message);
+                        reject(res.error);
+                    } else {
+                        resolve(res);
+                    }
+                });
+            } else {
+                reject(response.status);
+            }
+        }).catch(error => reject(error));
+    });
+}
+
+/*
+ * Call a method that returns a generator. Yields the items of its result as
+ * they arrive: for await (const item of callStream('method', args)) {...}
+ */
+export async function* callStream(method, args=[], kwargs={}) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {'Content-Type': codec.contentType, 'Accept': 'application/x-ndjson, ' + codec.contentType},
+        credentials: 'include',
+        body: codec.encode({method,args,kwargs,"version":2})
+    });
+    if (response.status != 200) {
+        throw response.status;
+    }
+    if (!(response.headers.get('Content-Type') || '').startsWith('application/x-ndjson')) {
+        const res = codec.decode(await response.arrayBuffer());
+        if (!res.success) {
+            console.log(res.error + ": " + res.error_message);
+            throw res.error;
+        }
+        yield* res.result;
+        return;
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const {done, value} = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), {stream: !done});
+        const lines = buffer.split('\\n');
+        buffer = done ? '' : lines.pop();
+        for (const line of lines) {
+            if (!line) continue;
+            const record = JSON.parse(line);
+            if ('result' in record) {
+                yield record.result;
+            } else if (!record.success) {
+                console.log(record.error + ": " + record.error_message);
+                throw record.error;
+            }
+        }
+        if (done) break;
+    }
+}
 
 """
 
 def gen_api(api_methods, url):
-    response = js_lib.replace("{{url}}", url)
-    for name, conf in api_methods.items():
-        response += gen_function(conf["method"], name, conf["details"]) + "\n"
+    cache_ttl = {name:invoker.max_age for name, invoker in api_methods.items()
+                 if invoker.idempotent and invoker.max_age}
+    response = js_lib.replace("{{url}}", url).replace("{{cache_ttl}}", json.dumps(cache_ttl))
+    for name, invoker in api_methods.items():
+        response += gen_function(invoker.method, name, invoker.details, idempotent=invoker.idempotent) + "\n"
 
     return response
 
@@ -1,4 +1,4 @@
-from inspect import signature
+from inspect import signature, isgeneratorfunction
 import json
 
 def gen_function(func, name, ignore_details, legacy=False):
@@ -12,15 +12,23 @@ def gen_function(func, name, ignore_details, legacy=False):
     args_str = ", ".join(args)
     if args:
         rest = ", " + args_str
-    return "def "+name+"("+args_str+"): return _call_method('"+name+"'"+rest+")"
+    function = "def "+name+"("+args_str+"): return _call_method('"+name+"'"+rest+")"
+    if isgeneratorfunction(func):
+        function += "\ndef "+name+"_stream("+args_str+"): return call_stream('"+name+"'"+rest+")"
+    return function
 
 
 py_lib = """# 
 # This code was generated by a tool.
 #
 
+import http.client
+import io
 import json
-import urllib.request
+import ssl
+import threading
+import urllib.error
+import urllib.parse
 
 class SimpleWebAPIError(Exception):
     def __init__(self, error_name="SimpleWebAPIError", message="An unknown error occured."):
@@ -29,8 +37,167 @@ class SimpleWebAPIError(Exception):
     def __str__(self):
         return str(self.error_name) + ": " + str(self.message)
 
+# Keep-alive HTTP/1.1 connections to one server, safe to share between threads.
+# size: Maximum number of idle connections kept open.
+# timeout: Socket timeout in seconds.
+class ConnectionPool:
+    def __init__(self, url, size=10, timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # Send a request and return the connection and the response.
+    def open(self, method, path, body, headers):
+        while True:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            reused = connection != None
+            if not reused:
+                connection = self.connect()
+            try:
+                connection.request(method, path, body, headers)
+                return connection, connection.getresponse()
+            except ConnectionError:
+                connection.close()
+                # The server may have closed an idle connection.
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+
+    # Keep a connection whose response has been read for reuse.
+    def release(self, connection, response):
+        if not response.will_close:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(connection)
+                    return
+        connection.close()
+
+    def check(self, response, data):
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(self.url, response.status, response.reason,
+                                         response.headers, io.BytesIO(data))
+
+    # Send a request and return the response body and headers.
+    # Raises urllib.error.HTTPError if the server returns an error status.
+    def request(self, method, path, body, headers):
+        connection, response = self.open(method, path, body, headers)
+        try:
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self.release(connection, response)
+        self.check(response, data)
+        return data, response.headers
+
+    # Send a request and return the response headers and an iterator
+    # over the lines of the response body as they arrive.
+    def stream(self, method, path, body, headers):
+        connection, response = self.open(method, path, body, headers)
+        if not 200 <= response.status < 300:
+            data = response.read()
+            self.release(connection, response)
+            self.check(response, data)
+
+        def lines():
+            done = False
+            try:
+                for line in response:
+                    yield line
+                # Mark the response finished so the connection can send another request.
+                response.close()
+                done = True
+            finally:
+                if done:
+                    self.release(connection, response)
+                else:
+                    connection.close()
+        return response.headers, lines()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            connection.close()
+
 token = None
 url = "{{url}}"
+# Wire encoding: "json", "msgpack" (needs msgpack) or "cbor" (needs cbor2).
+codec = "json"
+# Socket timeout in seconds.
+timeout = 60
+# Connections are kept open and reused. Calls may be made from several threads.
+_pool = None
+_pool_lock = threading.Lock()
+
+def _codec():
+    if codec == "msgpack":
+        import msgpack
+        return ("application/msgpack", lambda value: msgpack.packb(value, use_bin_type=True),
+                lambda data: msgpack.unpackb(data, raw=False))
+    elif codec == "cbor":
+        import cbor2
+        return "application/cbor", cbor2.dumps, cbor2.loads
+    return ("application/json", lambda value: json.dumps(value).encode('utf8'),
+            lambda data: json.loads(data.decode('utf-8')))
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool == None or _pool.url != url or _pool.timeout != timeout:
+            if _pool:
+                _pool.close()
+            _pool = ConnectionPool(url, timeout=timeout)
+        return _pool
+
+def _post(body):
+    content_type, dumps, loads = _codec()
+    pool = _get_pool()
+    data, headers = pool.request("POST", pool.path, dumps(body), {"Content-Type":content_type, "Accept":content_type})
+    return loads(data)
+
+# Call a method that returns a generator, yielding the items of its result
+# as they arrive instead of waiting for all of them.
+def call_stream(method, *args, **kwargs):
+    content_type, dumps, loads = _codec()
+    call = {"method":method,
+                "args":args,
+                "kwargs":kwargs,
+                "version":2}
+    if (token != None):
+        call["token"] = token
+    pool = _get_pool()
+    headers, lines = pool.stream("POST", pool.path, dumps(call),
+                                 {"Content-Type":content_type, "Accept":"application/x-ndjson, " + content_type})
+    if not headers.get("Content-Type", "").startswith("application/x-ndjson"):
+        result = loads(b"".join(lines))
+        if not result["success"]:
+            raise SimpleWebAPIError(message=result.get("error_message"), error_name=result.get("error"))
+        yield from result["result"]
+        return
+    for line in lines:
+        record = json.loads(line)
+        if "result" in record:
+            yield record["result"]
+        elif not record["success"]:
+            raise SimpleWebAPIError(message=record.get("error_message"), error_name=record.get("error"))
 
 def _call_method(method, *args, **kwargs):
     call = {"method":method,
@@ -39,22 +206,38 @@ def _call_method(method, *args, **kwargs):
                 "version":2}
     if (token != None):
         call["token"] = token
-    request = urllib.request.Request(url,
-            data=json.dumps(call).encode('utf8'),
-            headers={"Content-Type":"application/json"},
-            method="POST")
-    result = json.loads(urllib.request.urlopen(request).read().decode('utf-8'))
+    result = _post(call)
     if not result["success"]:
         raise SimpleWebAPIError(message=result.get("error_message"), error_name=result.get("error"))
     return result["result"]
 
+# Call several methods in one request. calls is a list of (method, args, kwargs)
+# tuples. Returns a list holding the result of each call, or the
+# SimpleWebAPIError it raised.
+def call_batch(calls):
+    batch = []
+    for method, *rest in calls:
+        call = {"method":method,
+                "args":list(rest[0]) if len(rest) > 0 else [],
+                "kwargs":rest[1] if len(rest) > 1 else {},
+                "version":2}
+        if (token != None):
+            call["token"] = token
+        batch.append(call)
+    results = _post(batch)
+    if not isinstance(results, list):
+        raise SimpleWebAPIError(message=results.get("error_message"), error_name=results.get("error"))
+    return [result["result"] if result["success"] else
+            SimpleWebAPIError(message=result.get("error_message"), error_name=result.get("error"))
+            for result in results]
+
 
 """
 
 def gen_api(api_methods, url):
     response = py_lib.replace("{{url}}", url)
-    for name, conf in api_methods.items():
-        response += gen_function(conf["method"], name, conf["details"]) + "\n"
+    for name, invoker in api_methods.items():
+        response += gen_function(invoker.method, name, invoker.details) + "\n"
 
     return response
 
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+class Limiter:
+    """Concurrency and rate limits for one API method.
+       max_concurrency: Maximum number of calls running at once, or None.
+       rate: Calls per second allowed on average, or None.
+       burst: Calls allowed at once before rate applies. Defaults to rate.
+       key: None to share the limits between all callers, or "user" or
+           "ip" to apply them to each user or address separately.
+       size: Maximum number of users or addresses tracked.
+       Calls over a limit are refused straight away instead of waiting."""
+    def __init__(self, max_concurrency=None, rate=None, burst=None, key=None, size=10000):
+        if key not in (None, "user", "ip"):
+            raise ValueError("key must be None, 'user' or 'ip'.")
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst if burst != None else max(rate or 0, 1)
+        self.key = key
+        self.size = size
+        # Calls in progress and token buckets, by key.
+        self.active = {}
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.refused = 0
+
+    def caller(self, details):
+        if self.key == None or details == None:
+            return None
+        return details.get(self.key)
+
+    def acquire(self, details):
+        """Start a call, returning its key for release, or False if the
+           call would exceed a limit."""
+        key = self.caller(details)
+        with self.lock:
+            active = self.active.get(key, 0)
+            if self.max_concurrency != None and active >= self.max_concurrency:
+                self.refused += 1
+                return False
+            if self.rate != None and not self.take(key):
+                self.refused += 1
+                return False
+            self.active[key] = active + 1
+        return key
+
+    def take(self, key):
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket == None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self.buckets.move_to_end(key)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+        return True
+
+    def release(self, key):
+        with self.lock:
+            active = self.active[key] - 1
+            if active:
+                self.active[key] = active
+            else:
+                del self.active[key]
+
+    def stats(self):
+        return {"active":sum(self.active.values()),
+                "refused":self.refused}
+
+def make_limiter(max_concurrency=None, rate=None, key=None):
+    """Make the limiter for a method's options, or None if it has no limits.
+       rate may be calls per second or a dict with rate and burst."""
+    if max_concurrency == None and rate == None:
+        return None
+    if isinstance(rate, dict):
+        return Limiter(max_concurrency, rate.get("rate"), rate.get("burst"), key)
+    return Limiter(max_concurrency, rate, key=key)
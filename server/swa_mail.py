@@ -0,0 +1,102 @@
+import atexit
+import queue
+import threading
+import time
+import traceback
+
+class MailgunTransport:
+    """Send email through the Mailgun API, reusing one HTTP session."""
+    def __init__(self, domain, api_key, sender, timeout=10):
+        self.url = "https://api.mailgun.net/v3/"+domain+"/messages"
+        self.api_key = api_key
+        self.sender = sender
+        self.timeout = timeout
+        # Imported here, as requests is slow to import and only needed to send mail.
+        import requests
+        self.session = requests.Session()
+
+    def send(self, recipient, subject, text):
+        response = self.session.post(self.url,
+            auth=("api", self.api_key),
+            data={"from": self.sender,
+                  "to": [recipient],
+                  "subject": subject,
+                  "text": text},
+            timeout=self.timeout)
+        response.raise_for_status()
+
+class PrintTransport:
+    """Print email instead of sending it."""
+    def send(self, recipient, subject, text):
+        print("To: "+recipient+"\nSubject: "+subject+"\nMessage: "+text)
+
+class MailQueue:
+    """Deliver email from background worker threads.
+       transport: Object with a send(recipient, subject, text) method.
+       workers: Number of delivery threads.
+       max_backlog: Maximum number of queued messages.
+       retries: Number of times a failed delivery is retried.
+       backoff: Delay before the first retry, doubled for each further retry."""
+    def __init__(self, transport, workers=2, max_backlog=1000, retries=3, backoff=1.0):
+        self.transport = transport
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(max_backlog)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker, name="swa-mail-"+str(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            atexit.register(self.stop)
+
+    def send(self, recipient, subject, text):
+        """Queue a message. Raises queue.Full if the backlog is full."""
+        if not self.threads:
+            self.start()
+        self.queue.put_nowait((recipient, subject, text))
+
+    def deliver(self, message):
+        for attempt in range(self.retries + 1):
+            try:
+                self.transport.send(*message)
+                self.sent += 1
+                return
+            except Exception:
+                if attempt == self.retries:
+                    traceback.print_exc()
+                else:
+                    time.sleep(self.backoff * 2 ** attempt)
+        self.failed += 1
+
+    def worker(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if message == None:
+                    return
+                self.deliver(message)
+            finally:
+                self.queue.task_done()
+
+    def stop(self, timeout=10):
+        """Deliver queued messages, waiting at most timeout seconds, and stop the workers."""
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            try:
+                self.queue.put(None, timeout=max(0.1, deadline - time.monotonic()))
+            except queue.Full:
+                return
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
@@ -0,0 +1,165 @@
+import threading
+import weakref
+from bisect import bisect_left
+from collections import defaultdict
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(key + "=\"" + escape(value) + "\"" for key, value in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def new_shard():
+    # Counters, histograms and per-method call histograms.
+    return (defaultdict(int), {}, {})
+
+def merge_shard(total, shard):
+    """Add the values in shard to total."""
+    for key, value in shard[0].copy().items():
+        total[0][key] += value
+    for totals, values in zip(total[1:], shard[1:]):
+        for key, value in values.copy().items():
+            if key in totals:
+                totals[key] = [a + b for a, b in zip(totals[key], value)]
+            else:
+                totals[key] = list(value)
+
+class Metrics:
+    """Counters and latency histograms in Prometheus text format.
+       Each thread records into its own shard, so recording takes no locks.
+       Shards are summed when the metrics are rendered, and the shards of
+       threads that have exited are folded into one when new shards are made."""
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.local = threading.local()
+        # Shards of running threads, with a weak reference to their thread.
+        self.shards = []
+        self.retired = new_shard()
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.collectors = []
+
+    def describe(self, name, kind, description):
+        """Set the type (counter, gauge or histogram) and help text of a metric."""
+        self.descriptions[name] = (kind, description)
+
+    def add_collector(self, function):
+        """Add a function called when rendering, returning a list of
+           (name, kind, description, [(labels, value), ...]) tuples.
+           labels is a tuple of (key, value) pairs."""
+        self.collectors.append(function)
+        return function
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = new_shard()
+            with self.lock:
+                self.retire_shards()
+                self.shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def retire_shards(self):
+        """Fold the shards of threads that have exited into self.retired.
+           Called with the lock held."""
+        live = []
+        for entry in self.shards:
+            thread = entry[0]()
+            if thread != None and thread.is_alive():
+                live.append(entry)
+            else:
+                merge_shard(self.retired, entry[1])
+        self.shards = live
+
+    def observe(self, name, labels, value):
+        try:
+            histograms = self.local.shard[1]
+        except AttributeError:
+            histograms = self.shard()[1]
+        histogram = histograms.get((name, labels))
+        if histogram == None:
+            # Bucket counts, followed by the sum and count of observations.
+            histogram = histograms[(name, labels)] = [0] * (len(self.buckets) + 3)
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record_call(self, name, res, duration, auth=None):
+        """Record a call to the API method name that produced the version 2
+           result res. auth is the time taken to resolve the caller before the
+           call, if it was resolved. Calls are counted by the latency histogram,
+           so swa_calls_total is only worked out when rendering."""
+        try:
+            histogram = self.local.shard[2][name]
+        except (AttributeError, KeyError):
+            # Bucket counts, the sum and count of caller lookups, then the
+            # sum and count of calls.
+            histogram = self.shard()[2][name] = [0] * (len(self.buckets) + 5)
+        histogram[bisect_left(self.buckets, duration)] += 1
+        histogram[-2] += duration
+        histogram[-1] += 1
+        if auth is not None:
+            histogram[-4] += auth
+            histogram[-3] += 1
+        if not res["success"]:
+            self.local.shard[0][("swa_errors_total", (("method", name), ("error", res["error"])))] += 1
+
+    def collect(self):
+        total = new_shard()
+        with self.lock:
+            self.retire_shards()
+            merge_shard(total, self.retired)
+            shards = [shard for thread, shard in self.shards]
+        for shard in shards:
+            merge_shard(total, shard)
+        counters, histograms, calls = total
+        for name, value in calls.items():
+            labels = (("method", name),)
+            counters[("swa_calls_total", labels)] += value[-1]
+            if value[-3]:
+                counters[("swa_auth_seconds_total", labels)] += value[-4]
+                counters[("swa_auth_total", labels)] += value[-3]
+            histograms[("swa_handler_seconds", labels)] = value
+        return counters, histograms
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        families = defaultdict(list)
+        for (name, labels), value in sorted(counters.items()):
+            families[name].append(name + format_labels(labels) + " " + format_value(value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram):
+                total += count
+                families[name].append(name + "_bucket" + format_labels(labels, (("le", format_value(bound)),))
+                                      + " " + str(total))
+            families[name].append(name + "_sum" + format_labels(labels) + " " + format_value(histogram[-2]))
+            families[name].append(name + "_count" + format_labels(labels) + " " + str(histogram[-1]))
+        descriptions = dict(self.descriptions)
+        for collector in self.collectors:
+            for name, kind, description, samples in collector():
+                descriptions[name] = (kind, description)
+                for labels, value in samples:
+                    families[name].append(name + format_labels(labels) + " " + format_value(value))
+        lines = []
+        for name, samples in families.items():
+            if name in descriptions:
+                kind, description = descriptions[name]
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " " + kind)
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
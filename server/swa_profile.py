@@ -0,0 +1,115 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+
+# Names accepted by Profiler.report for sorting the results.
+sort_keys = pstats.Stats.sort_arg_dict_default
+
+class ProfiledInvoker:
+    """Stands in for a method's invoker while the method is being profiled."""
+    __slots__ = ("invoker", "profiler")
+
+    def __init__(self, invoker, profiler):
+        self.invoker = invoker
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.invoker, name)
+
+    def __call__(self, inp, capabilities, details=None, auth_start=None):
+        return self.profiler.run(self.invoker, inp, capabilities, details, auth_start)
+
+class Profiler:
+    """Profile calls to API methods with cProfile on request.
+       Methods are only swapped for a ProfiledInvoker while profiling,
+       so calls are not slowed down at other times. One call is profiled
+       at a time; calls made while another is being profiled are skipped."""
+    def __init__(self, api_methods):
+        self.api_methods = api_methods
+        self.lock = threading.Lock()
+        self.run_lock = threading.Lock()
+        self.stats = None
+        self.calls = 0
+        self.remaining = 0
+        self.sample = 1.0
+        self.dump_dir = None
+
+    def start(self, names, calls, sample=1.0, dump_dir=None):
+        """Profile the next calls calls to the methods in names, choosing each
+           call with probability sample. Clears the previous results.
+           If dump_dir is set, the results are saved there when done."""
+        with self.lock:
+            self.restore()
+            self.stats = None
+            self.calls = 0
+            self.remaining = calls
+            self.sample = sample
+            self.dump_dir = dump_dir
+            for name in names:
+                self.api_methods[name] = ProfiledInvoker(self.api_methods[name], self)
+
+    def stop(self):
+        with self.lock:
+            self.remaining = 0
+            self.restore()
+
+    def restore(self):
+        for name, invoker in list(self.api_methods.items()):
+            if isinstance(invoker, ProfiledInvoker):
+                self.api_methods[name] = invoker.invoker
+
+    def run(self, invoker, inp, capabilities, details, auth_start=None):
+        if self.sample < 1 and random.random() >= self.sample:
+            return invoker(inp, capabilities, details, auth_start)
+        if not self.run_lock.acquire(blocking=False):
+            return invoker(inp, capabilities, details, auth_start)
+        try:
+            if self.remaining <= 0:
+                return invoker(inp, capabilities, details, auth_start)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler, such as a debugger, is active.
+                return invoker(inp, capabilities, details, auth_start)
+            try:
+                return invoker(inp, capabilities, details, auth_start)
+            finally:
+                profile.disable()
+                self.add(profile)
+        finally:
+            self.run_lock.release()
+
+    def add(self, profile):
+        with self.lock:
+            if self.remaining <= 0:
+                return
+            if self.stats == None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.calls += 1
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.restore()
+                if self.dump_dir:
+                    self.stats.dump_stats(os.path.join(self.dump_dir,
+                        "swa-" + time.strftime("%Y%m%d-%H%M%S") + ".pstats"))
+
+    def report(self, sort="cumulative", limit=50):
+        """Return the state of the profiler and the results as text."""
+        with self.lock:
+            text = ""
+            if self.stats != None:
+                out = io.StringIO()
+                self.stats.stream = out
+                self.stats.sort_stats(sort).print_stats(limit)
+                text = out.getvalue()
+            return {"active":self.remaining > 0,
+                    "calls":self.calls,
+                    "remaining":self.remaining,
+                    "stats":text}
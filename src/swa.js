@@ -24,15 +24,96 @@ function jsonRequest(url, data) {
   })
 }
 
+function getJSON(url) {
+  return new Promise(function (resolve, reject) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url, true);
+    xhr.onloadend = function () {
+      if (xhr.status !== 200) {
+        reject(xhr.status);
+      } else {
+        resolve(JSON.parse(xhr.response));
+      }
+    };
+    xhr.send();
+  })
+}
+
 class SimpleWebAPI {
-  constructor(url) {
+  // Calls to idempotent methods with the same arguments share one request
+  // while it is in flight, and their results are kept for the max_age the
+  // server gives the method. Shared results must not be modified.
+  constructor(url, cacheSize=500) {
     this.url = url;
+    this.cacheSize = cacheSize;
+    this.cacheTTL = {};
+    this.cache = new Map();
+    this.inflight = new Map();
+    this.generation = 0;
   }
   async callMethod(method, args) {
-    return await jsonRequest(this.url, {"method":method,"args":args,"version":2});
+    if (!(method in this.cacheTTL)) {
+      return await jsonRequest(this.url, {"method":method,"args":args,"version":2});
+    }
+    var key = method + '\n' + JSON.stringify(args);
+    var entry = this.cache.get(key);
+    if (entry) {
+      this.cache.delete(key);
+      if (entry.expires > Date.now()) {
+        this.cache.set(key, entry);
+        return entry.value;
+      }
+    }
+    if (!this.inflight.has(key)) {
+      var api = this;
+      var started = this.generation;
+      var promise = jsonRequest(this.url, {"method":method,"args":args,"version":2}).then(function (value) {
+        var ttl = api.cacheTTL[method];
+        if (ttl && api.cacheSize > 0 && started == api.generation) {
+          api.cache.set(key, {expires: Date.now() + ttl * 1000, value: value});
+          while (api.cache.size > api.cacheSize) api.cache.delete(api.cache.keys().next().value);
+        }
+        return value;
+      }).finally(function () {
+        if (api.inflight.get(key) === promise) api.inflight.delete(key);
+      });
+      this.inflight.set(key, promise);
+    }
+    return await this.inflight.get(key);
+  }
+  // Drop kept results for a call to method with args, all results of method
+  // if args is not given, or every result if method is not given.
+  invalidate(method, args) {
+    this.generation++;
+    [this.cache, this.inflight].forEach(function (entries) {
+      if (method === undefined) {
+        entries.clear();
+      } else if (args === undefined) {
+        Array.from(entries.keys()).forEach(function (key) {
+          if (key.startsWith(method + '\n')) entries.delete(key);
+        });
+      } else {
+        entries.delete(method + '\n' + JSON.stringify(args));
+      }
+    });
+  }
+  async loadHints() {
+    var schema;
+    try {
+      schema = await getJSON(this.url.replace(/\/?$/, '/.schema'));
+    } catch (e) {
+      return;
+    }
+    var api = this;
+    Object.keys(schema.methods).forEach(function (method) {
+      if (schema.methods[method].idempotent) {
+        api.cacheTTL[method] = schema.methods[method].max_age || 0;
+      }
+    });
   }
   async genMethods() {
-    var methods = await this.callMethod("getMethods",[]);
+    var results = await Promise.all([this.callMethod("getMethods",[]), this.loadHints()]);
+    var methods = results[0];
     var api = this;
     methods.forEach(function(method) {
       api[method] = async function() {
@@ -41,4 +122,3 @@ class SimpleWebAPI {
     });
   }
 }
-
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from swa import SimpleWebAPI
+
+def make_api():
+    api = SimpleWebAPI()
+
+    @api.add(require=None, idempotent=True)
+    def export(count):
+        for i in range(count):
+            time.sleep(0.2)
+            yield i
+
+    @api.add(require=None)
+    async def ping():
+        return "pong"
+
+    return api
+
+async def request(api, body=None, query=b""):
+    """Send one request through asgi_application, returning the status,
+       the body and when the response finished."""
+    scope = {"type":"http", "method":"POST" if body is not None else "GET", "path":"/",
+             "root_path":"", "query_string":query, "scheme":"http", "http_version":"1.1",
+             "headers":[(b"content-type", b"application/json"), (b"host", b"example.com")],
+             "client":("127.0.0.1", 1234), "server":("example.com", 80)}
+    messages = [{"type":"http.request", "more_body":False,
+                 "body":json.dumps(body).encode() if body is not None else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await api.asgi_application(scope, receive, send)
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:]), time.monotonic()
+
+def run_alongside_export(export):
+    """Start export, then ping the API while it runs. Returns both results."""
+    api = make_api()
+
+    async def main():
+        task = asyncio.ensure_future(export(api))
+        await asyncio.sleep(0.05)
+        ping = await request(api, {"method":"ping", "version":2})
+        return await task, ping
+
+    return asyncio.run(main())
+
+def test_collected_export_does_not_block_other_calls():
+    export, ping = run_alongside_export(lambda api: request(api, {"method":"export", "args":[3], "version":2}))
+    assert json.loads(export[1]) == {"success":True, "result":[0, 1, 2]}
+    assert json.loads(ping[1]) == {"success":True, "result":"pong"}
+    assert export[2] - ping[2] > 0.3
+
+def test_batched_export_does_not_block_other_calls():
+    export, ping = run_alongside_export(lambda api: request(api, [{"method":"export", "args":[3]}]))
+    assert json.loads(export[1]) == [{"success":True, "result":[0, 1, 2]}]
+    assert export[2] - ping[2] > 0.3
+
+def test_get_export_does_not_block_other_calls():
+    export, ping = run_alongside_export(lambda api: request(api, query=b"method=export&args=%5B3%5D"))
+    assert export[0] == 200
+    assert json.loads(export[1]) == {"success":True, "result":[0, 1, 2]}
+    assert export[2] - ping[2] > 0.3
@@ -0,0 +1,35 @@
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from swa import SimpleWebAPI
+from werkzeug.test import Client
+
+def make_api():
+    api = SimpleWebAPI()
+    api.metrics_enabled = True
+
+    @api.add(require=None)
+    def echo(x):
+        return x
+
+    return api
+
+def call(api, x):
+    response = Client(api.application).post("/", json={"method":"echo", "args":[x], "version":2})
+    assert json.loads(response.data) == {"success":True, "result":x}
+
+def test_short_lived_threads_do_not_keep_shards():
+    api = make_api()
+    for i in range(200):
+        thread = threading.Thread(target=call, args=(api, i))
+        thread.start()
+        thread.join()
+    call(api, "last")
+    assert len(api.metrics.shards) <= 2
+    counters, histograms = api.metrics.collect()
+    assert counters[("swa_calls_total", (("method", "echo"),))] == 201
+    assert histograms[("swa_handler_seconds", (("method", "echo"),))][-1] == 201
+    assert 'swa_calls_total{method="echo"} 201' in api.metrics.render()
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import threading
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from werkzeug.test import Client
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "server"))
+sys.path.insert(0, os.path.join(root, "python-api-client"))
+from swa import SimpleWebAPI
+import swac
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def make_api():
+    api = SimpleWebAPI()
+
+    @api.add(require=None)
+    def mixed(options={1:"a", "b":2}):
+        return len(options)
+
+    @api.add(require=None)
+    def numbered(options={10:"a", 9:"b"}):
+        return len(options)
+
+    return api
+
+def test_defaults_with_mixed_keys_do_not_break_calls():
+    response = Client(make_api().application).post("/", json={"method":"mixed", "version":2})
+    assert response.status_code == 200
+    assert json.loads(response.data) == {"success":True, "result":2}
+
+def test_hash_matches_schema_loaded_from_json():
+    schema = json.loads(json.dumps(make_api().schema()))
+    assert swac.schema_hash(schema["methods"]) == schema["hash"]
+
+def test_schema_fetched_once(tmp_path):
+    api = make_api()
+    fetches = []
+
+    def application(environ, start_response):
+        if environ["PATH_INFO"].endswith("/.schema"):
+            fetches.append(environ["PATH_INFO"])
+        return api.application(environ, start_response)
+
+    server = make_server("127.0.0.1", 0, application, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = swac.api("http://127.0.0.1:" + str(server.server_port) + "/api/",
+                          schema_cache=str(tmp_path / "schema.json"))
+        for i in range(10):
+            assert client.numbered() == 2
+        client.close()
+    finally:
+        server.shutdown()
+    assert len(fetches) == 1
+
+def test_unbindable_schema_fetched_once(tmp_path):
+    client = swac.api("http://127.0.0.1:9/api/", schema_cache=str(tmp_path / "schema.json"))
+    headers = {"X-SWA-Schema":"0" * 32}
+    assert client._schema_changed(headers)
+    assert not client._schema_changed(headers)
+    assert client._schema_changed({"X-SWA-Schema":"1" * 32})
@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from sqlalchemy import create_engine
+from swa import SimpleWebAPI
+from email_session_manager import EmailSessionManager
+
+def make_manager(path):
+    manager = EmailSessionManager(SimpleWebAPI(), create_engine("sqlite:///" + str(path / "sessions.db")))
+    manager.upd_settings({"roles":{"admin":["user"], "user":None, "nobody":None},
+                          "default_role":"user", "admin_user":"root@example.com", "reap_interval":0})
+    return manager
+
+def change_before_put(manager, change):
+    """Run change after the next session lookup has read the database but
+       before it stores the identity in the session cache."""
+    cache = manager.session_cache
+    put = cache.put
+
+    def late_put(*args):
+        cache.put = put
+        change()
+        put(*args)
+
+    cache.put = late_put
+
+def test_logoff_during_lookup_is_not_undone(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.get_or_register_user("a@example.com")
+    token = manager.gen_token("a@example.com")
+    change_before_put(manager, lambda: manager.logoff({"token":token}))
+    assert manager.resolve_token(token)["user"] == "a@example.com"
+    assert manager.resolve_token(token) == None
+
+def test_role_change_during_lookup_is_not_undone(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.get_or_register_user("a@example.com")
+    token = manager.gen_token("a@example.com")
+    change_before_put(manager, lambda: manager.set_user_role("a@example.com", "nobody"))
+    assert manager.resolve_token(token)["role"] == "user"
+    assert manager.resolve_token(token)["role"] == "nobody"